@@ -0,0 +1,579 @@
+"""Benchmarks for TFT-MoodeCoverArt
+
+Measures the cost of the display hot path so performance changes can be
+compared before and after, on a Pi or on a development machine.
+
+Everything runs offline: the display is an in-memory framebuffer and MPD is
+a small local fake server, so no Pi, SPI panel or MPD install is needed.
+
+Benchmarks:
+- conversion: RGB565 framebuffer conversion time and per-frame memory
+  allocations for the legacy list based path and the persistent buffers
+- loop: the real display loop with scrolling text and track changes;
+  reports frames per second, per-stage latency percentiles and SPI bytes
+  per frame
+- covers: cover load time over a corpus of audio files with large embedded
+  art, cold (decode and resize) and warm (cover cache hit)
+- buttons: time from a button edge to the updated frame on the display
+- replay: a recorded trace (``trace: record`` in config.yml, or a synthetic
+  one with radio title churn, rapid skips, source switches and long titles)
+  played through the display loop into an offscreen display in virtual
+  time; reports per-frame timing and the frame hashes, which are identical
+  for the same trace and settings
+
+Usage:
+    python3 benchmark.py
+    python3 benchmark.py conversion --frames 200
+    python3 benchmark.py loop --seconds 10
+    python3 benchmark.py covers --corpus /mnt/music/Box-Set
+    python3 benchmark.py replay --trace cache/trace-default.jsonl.gz --hashes before.txt
+
+Author: Original by rusconi, Enhanced fork by cachamber
+"""
+
+import argparse
+import hashlib
+import io
+import os
+import socket
+import tempfile
+import threading
+import time
+import tracemalloc
+import wave
+
+from mediafile import MediaFile
+from PIL import Image
+
+import tft_moode_coverart as tft
+
+
+class NullPanel:
+    """Stand-in for the ST7789 that only counts the bytes it is sent."""
+
+    def __init__(self, rotation=0):
+        self._rotation = rotation
+        self.bytes = 0
+
+    def set_window(self, x0=0, y0=0, x1=None, y1=None):
+        pass
+
+    def data(self, data):
+        self.bytes += len(data)
+
+
+class FakeMPDServer:
+    """Minimal local MPD server for driving the display loop offline.
+
+    Speaks enough of the MPD protocol for this script: status, currentsong,
+    playlistid, idle/noidle, ping and the button commands (play, pause,
+    setvol, next, previous). Tests change the player state with update(),
+    which also wakes idling clients like a real MPD would; changes made
+    while a client is busy are reported on its next idle.
+
+    Args:
+        status (dict): Initial status values
+    """
+
+    def __init__(self, status=None):
+        self.status = {'state': 'play', 'volume': '60', 'elapsed': '0.000',
+                       'duration': '240.000', 'songid': '1'}
+        self.status.update(status or {})
+        self.songs = {}
+        self.lock = threading.Lock()
+        self.idlers = []
+        self.missed = {}
+        self.commands = 0
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(8)
+        self.host, self.port = self.server.getsockname()
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self.server.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _send(self, conn, pairs=()):
+        try:
+            conn.sendall(''.join('{}: {}\n'.format(k, v) for k, v in pairs).encode() + b'OK\n')
+        except OSError:
+            pass
+
+    def _serve(self, conn):
+        try:
+            self._dispatch(conn)
+        except OSError:
+            pass
+        with self.lock:
+            self.missed.pop(conn, None)
+            if conn in self.idlers:
+                self.idlers.remove(conn)
+        conn.close()
+
+    def _dispatch(self, conn):
+        self._track(conn)
+        conn.sendall(b'OK MPD 0.23.5\n')
+        for line in conn.makefile('r', encoding='utf-8'):
+            words = line.split()
+            command = words[0] if words else ''
+            with self.lock:
+                self.commands += 1
+                if command == 'idle':
+                    missed = self.missed[conn]
+                    if missed:
+                        self._send(conn, [('changed', sub) for sub in sorted(missed)])
+                        missed.clear()
+                    else:
+                        self.idlers.append(conn)
+                    continue
+                if command == 'noidle':
+                    if conn in self.idlers:
+                        self.idlers.remove(conn)
+                        self._send(conn)
+                    continue
+                if command == 'status':
+                    pairs = list(self.status.items())
+                elif command == 'currentsong':
+                    pairs = list(self.songs.get(self.status.get('songid'), {}).items())
+                elif command == 'playlistid':
+                    song_id = words[1].strip('"') if len(words) > 1 else ''
+                    pairs = list(self.songs.get(song_id, {}).items())
+                else:
+                    pairs = []
+                    if command == 'setvol':
+                        self.status['volume'] = words[1].strip('"')
+                        self._changed('mixer')
+                    elif command in ('play', 'pause'):
+                        paused = (command == 'pause') and (words[1:2] != ['"0"'])
+                        self.status['state'] = 'pause' if paused else 'play'
+                        self._changed('player')
+                    elif command in ('next', 'previous'):
+                        self._changed('player')
+            self._send(conn, pairs)
+
+    def update(self, subsystem='player', **status):
+        """Change status values and notify idling clients.
+
+        Args:
+            subsystem (str): MPD subsystem reported as changed
+            **status: Status values to set (None removes a key)
+        """
+        with self.lock:
+            for key, value in status.items():
+                if value is None:
+                    self.status.pop(key, None)
+                else:
+                    self.status[key] = str(value)
+            self._changed(subsystem)
+
+    def _changed(self, subsystem):
+        # caller holds the lock
+        for conn, missed in self.missed.items():
+            if conn in self.idlers:
+                self._send(conn, [('changed', subsystem)])
+            else:
+                missed.add(subsystem)
+        self.idlers = []
+
+    def _track(self, conn):
+        with self.lock:
+            self.missed.setdefault(conn, set())
+
+    def close(self):
+        self.server.close()
+
+
+class FakeGPIO:
+    """RPi.GPIO stand-in that lets the benchmark trigger button edges."""
+
+    BCM = 'BCM'
+    IN = 'IN'
+    PUD_UP = 'PUD_UP'
+    FALLING = 'FALLING'
+
+    def __init__(self):
+        self.callbacks = {}
+
+    def setmode(self, mode):
+        pass
+
+    def setup(self, pin, direction, pull_up_down=None):
+        pass
+
+    def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+        self.callbacks[pin] = callback
+
+    def remove_event_detect(self, pin):
+        self.callbacks.pop(pin, None)
+
+    def cleanup(self, pins=None):
+        pass
+
+    def press(self, pin):
+        """Fire the pin's edge callback on a separate thread, like RPi.GPIO."""
+        threading.Thread(target=self.callbacks[pin], args=(pin,)).start()
+
+
+def write_metadata(filename, **fields):
+    """Write a Moode style currentsong.txt."""
+    fields.setdefault('coverurl', 'images/default-cover-v6.svg')
+    with open(filename + '.tmp', 'w') as metafile:
+        for key, value in fields.items():
+            metafile.write('{}={}\n'.format(key, value))
+    os.replace(filename + '.tmp', filename)
+
+
+def make_corpus(directory, count, size):
+    """Create audio files with large embedded cover art.
+
+    Args:
+        directory (str): Directory to create the files in
+        count (int): Number of files
+        size (int): Edge length of the embedded JPEG in pixels
+
+    Returns:
+        list: Paths of the created files
+    """
+    files = []
+    for i in range(count):
+        fp = os.path.join(directory, 'track{:02d}.wav'.format(i))
+        with wave.open(fp, 'wb') as audio:
+            audio.setnchannels(1)
+            audio.setsampwidth(2)
+            audio.setframerate(8000)
+            audio.writeframes(b'\0\0' * 800)
+        art = io.BytesIO()
+        Image.effect_noise((size, size), 40 + i).convert('RGB').save(art, 'JPEG', quality=90)
+        mf = MediaFile(fp)
+        mf.art = art.getvalue()
+        mf.save()
+        files.append(fp)
+    return files
+
+
+def percentile_ms(samples, point):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * point / 100))] * 1000
+
+
+def measure(fn, frames):
+    """Run fn once per frame and return timing and allocation figures.
+
+    Args:
+        fn (callable): Function called with the frame number
+        frames (int): Number of frames to run
+
+    Returns:
+        dict: Mean time per frame in ms, peak transient allocation per frame in
+              bytes and allocated memory blocks per frame
+    """
+    fn(0)
+    peak = 0
+    blocks = 0
+    tracemalloc.start()
+    for i in range(frames):
+        before = tracemalloc.get_traced_memory()[0]
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+        fn(i)
+        peak = max(peak, tracemalloc.get_traced_memory()[1] - before)
+        stats = tracemalloc.take_snapshot().compare_to(snapshot, 'lineno')
+        blocks += sum(stat.count_diff for stat in stats if stat.count_diff > 0)
+    tracemalloc.stop()
+    start = time.perf_counter()
+    for i in range(frames):
+        fn(i)
+    elapsed = time.perf_counter() - start
+    return {
+        'ms': elapsed / frames * 1000,
+        'peak_bytes': peak,
+        'blocks': blocks / frames,
+    }
+
+
+def bench_conversion(frames):
+    """Compare RGB565 conversion paths on a scrolling-title frame."""
+    background = Image.effect_noise(tft.GEOMETRY.size, 64).convert('RGB')
+    sprite = tft.TextSprite('A very long title that has to scroll across the screen',
+                            tft.load_font(tft.FONT, 30), (255, 255, 255), (15, 15, 15), 3)
+    frame = background.copy()
+
+    def draw(i):
+        frame.paste(background)
+        return sprite.paste(frame, -(i % sprite.width), 105)
+
+    def legacy(i):
+        # what st7789.ST7789.display() does for every frame
+        draw(i)
+        pixels = tft.image_to_rgb565(frame)
+        data = list(pixels.astype('>u2').tobytes())
+        for j in range(0, len(data), 4096):
+            data[j:j + 4096]
+
+    full_panel = NullPanel()
+    full = tft.DamageTracker(full_panel, partial=False)
+
+    def persistent(i):
+        draw(i)
+        full.display(frame)
+
+    layer_panel = NullPanel()
+    layered = tft.DamageTracker(layer_panel)
+
+    def patched(i):
+        box = draw(i)
+        layered.display(frame, ('background', background, [box]))
+
+    results = [
+        ('legacy list conversion', measure(legacy, frames)),
+        ('persistent buffers, full frame', measure(persistent, frames)),
+        ('persistent buffers, patched regions', measure(patched, frames)),
+    ]
+    print('RGB565 conversion ({} frames)'.format(frames))
+    for name, result in results:
+        print('  {:<38} {:7.2f} ms/frame {:9d} peak bytes {:7.1f} blocks/frame'.format(
+            name, result['ms'], result['peak_bytes'], result['blocks']))
+
+
+def bench_loop(args):
+    """Run the real display loop against fake MPD servers and displays.
+
+    With ``--screens`` above one, one process drives that many display/player
+    pairs, all playing the same albums, through the ``screens`` setting.
+    """
+    workdir = tempfile.mkdtemp(prefix='tft-bench-')
+    servers = [FakeMPDServer() for _ in range(args.screens)]
+    metadata = [os.path.join(workdir, 'currentsong{}.txt'.format(n)) for n in range(args.screens)]
+    tft.MPD_HOST, tft.MPD_PORT = servers[0].host, servers[0].port
+    tft.METADATA_FILE = metadata[0]
+    tft.MUSIC_DIR = workdir + '/'
+    tft.COVER_CACHE_DIR = os.path.join(workdir, 'covers')
+    tracks = make_corpus(workdir, 3, 1500)
+    if args.record:
+        tft.TRACE_RECORD = os.path.abspath(args.record)
+    width, height = (int(n) for n in args.panel.split('x'))
+    display = {'backend': 'memory', 'width': width, 'height': height, 'rotation': args.rotation}
+    if args.screens > 1:
+        tft.SCREENS = [{'name': 'screen{}'.format(n), 'host': server.host, 'port': server.port,
+                        'metadata': metadata[n], 'display': display}
+                       for n, server in enumerate(servers)]
+    else:
+        tft.disp = tft.create_display(**display)
+
+    def play(n):
+        for server, filename in zip(servers, metadata):
+            write_metadata(filename, file=os.path.basename(tracks[n % len(tracks)]),
+                           artist='An Artist With A Rather Long Name', album='Album',
+                           title='Track {} with a title long enough to scroll across the display'.format(n))
+            server.update('player', songid=n + 1, elapsed='0.000')
+
+    play(0)
+    stop = threading.Event()
+    loop = threading.Thread(target=tft.main, args=(stop,), daemon=True)
+    loop.start()
+    time.sleep(1.0)
+    tft.stats.reset()
+    start = time.monotonic()
+    cpu_start = time.process_time()
+    track = 0
+    while time.monotonic() - start < args.seconds:
+        time.sleep(min(2.0, args.seconds))
+        track += 1
+        play(track)
+        for server in servers:
+            server.update('mixer', volume=20 + (track * 7) % 80)
+    elapsed = time.monotonic() - start
+    cpu = time.process_time() - cpu_start
+    stop.set()
+    for server in servers:
+        server.update('player')
+    loop.join(5)
+    for server in servers:
+        server.close()
+
+    frames = tft.stats.counters.get('frames', 0)
+    print('Display loop ({:.1f} s, {} track changes, {} screens, {} panel)'.format(
+        elapsed, track, args.screens, args.panel))
+    print('  {:>8.1f} frames/s per screen'.format(frames / elapsed / args.screens))
+    print('  {:>8.1f} % CPU'.format(100.0 * cpu / elapsed))
+    print('  {:>8.0f} SPI bytes/frame'.format(tft.stats.counters.get('spi_bytes', 0) / max(frames, 1)))
+    print('  {:>8} frames dropped'.format(tft.stats.counters.get('frames_dropped', 0)))
+    print('  {:>8.1f} MB peak RSS'.format(tft.memory_usage()[1] / 1048576))
+    print('  {:<14} {:>8} {:>8} {:>8} {:>8}'.format('stage', 'p50 ms', 'p90 ms', 'p99 ms', 'samples'))
+    for stage in ('sleep', 'mpd', 'metadata', 'cover', 'cover_resolve', 'cover_resize', 'blur', 'text', 'hash',
+                  'compose', 'convert', 'spi'):
+        samples = list(tft.stats.samples.get(stage, ()))
+        if samples:
+            print('  {:<14} {:>8.2f} {:>8.2f} {:>8.2f} {:>8}'.format(
+                stage, percentile_ms(samples, 50), percentile_ms(samples, 90),
+                percentile_ms(samples, 99), len(samples)))
+
+
+def bench_buttons(args):
+    """Measure the time from a button edge to the updated frame on the display."""
+    workdir = tempfile.mkdtemp(prefix='tft-bench-')
+    server = FakeMPDServer({'volume': '50'})
+    tft.MPD_HOST, tft.MPD_PORT = server.host, server.port
+    tft.METADATA_FILE = os.path.join(workdir, 'currentsong.txt')
+    tft.COVER_CACHE_DIR = os.path.join(workdir, 'covers')
+    tft.OVERLAY = 2
+    tft.BUTTONS = 1
+    tft.gpio = FakeGPIO()
+    tft.disp = tft.create_display('memory')
+    write_metadata(tft.METADATA_FILE, file='Album/track.flac', artist='Artist', album='Album', title='Title')
+    pins = {action: pin for pin, action in tft.BUTTON_PINS.items()}
+    stop = threading.Event()
+    loop = threading.Thread(target=tft.main, args=(stop,), daemon=True)
+    loop.start()
+    time.sleep(1.0)
+    latencies = []
+    for i in range(args.presses):
+        action = ('volume_up', 'volume_down', 'play_pause')[i % 3]
+        frames = tft.disp.frames
+        start = time.perf_counter()
+        tft.gpio.press(pins[action])
+        while (tft.disp.frames == frames) and (time.perf_counter() - start < 1.0):
+            time.sleep(0.0002)
+        latencies.append(time.perf_counter() - start)
+        # stay clear of the debounce window
+        time.sleep(tft.BUTTON_BOUNCE / 1000.0 + 0.05)
+    stop.set()
+    server.update('player')
+    loop.join(5)
+    server.close()
+    print('Button press to frame ({} presses)'.format(len(latencies)))
+    print('  p50 {:6.1f} ms  p90 {:6.1f} ms  max {:6.1f} ms'.format(
+        percentile_ms(latencies, 50), percentile_ms(latencies, 90), max(latencies) * 1000))
+    print('  MPD state after presses: volume {}, {}'.format(server.status['volume'], server.status['state']))
+
+
+def bench_covers(args):
+    """Time cover loading over a corpus of audio files."""
+    workdir = tempfile.mkdtemp(prefix='tft-bench-')
+    if args.corpus:
+        corpus = os.path.abspath(args.corpus)
+        files = [os.path.join(root, name) for root, _, names in os.walk(corpus) for name in names
+                 if name.lower().endswith(('.flac', '.mp3', '.m4a', '.ogg', '.wav', '.dsf', '.aiff'))]
+    else:
+        corpus = workdir
+        files = make_corpus(workdir, args.count, args.art_size)
+    tft.MUSIC_DIR = corpus + '/'
+    cache = tft.CoverCache(os.path.join(workdir, 'covers'), max_entries=len(files) + 1, max_mb=1024)
+    cold = []
+    warm = []
+    for fp in files:
+        meta = {'source': 'library', 'file': os.path.relpath(fp, corpus)}
+        start = time.perf_counter()
+        tft.load_cover(meta, cache)
+        cold.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        tft.load_cover(meta, cache)
+        warm.append(time.perf_counter() - start)
+    print('Cover load ({} files)'.format(len(files)))
+    for name, samples in (('cold', cold), ('warm', warm)):
+        if samples:
+            print('  {:<5} p50 {:8.1f} ms  p90 {:8.1f} ms  max {:8.1f} ms'.format(
+                name, percentile_ms(samples, 50), percentile_ms(samples, 90), max(samples) * 1000))
+
+
+def synthetic_trace(path):
+    """Write a trace of the sequences that are hard to reproduce by hand."""
+    clock = [0.0]
+    recorder = tft.TraceRecorder(path, 'synthetic', clock=lambda: clock[0])
+    long_title = 'A title long enough to scroll across the display, twice over if possible'
+
+    def at(seconds, kind, value):
+        clock[0] = seconds
+        recorder.record(kind, value, seconds)
+
+    t = 0.0
+    # radio stream with a new title every few seconds
+    at(t, 'status', {'state': 'play', 'volume': '60', 'elapsed': '0.000', 'songid': '1'})
+    for n in range(6):
+        at(t, 'meta', {'source': 'radio', 'file': 'http://radio.example/stream', 'coverurl': 'imagesw/radio-logos/x.jpg',
+                       'artist': 'Radio Station', 'album': 'Radio Station', 'title': 'Song {} - {}'.format(n, long_title)})
+        t += 3.0
+    # rapid skips through library tracks, with volume changes in between
+    for n in range(20):
+        at(t, 'status', {'state': 'play', 'volume': str(40 + n), 'elapsed': '0.000', 'duration': '240.000',
+                         'songid': str(10 + n)})
+        at(t, 'meta', {'source': 'library', 'file': 'Album/{:02}.flac'.format(n), 'artist': 'Artist',
+                       'album': 'Album', 'title': long_title if n % 2 else 'Track {}'.format(n)})
+        t += 0.3
+    t += 5.0
+    # Bluetooth, Airplay and Spotify take over in turn, then pause
+    for source in ('bluetooth', 'airplay', 'spotify', 'library'):
+        at(t, 'meta', {'source': source, 'file': source.title() + ' Active'})
+        t += 2.0
+    at(t, 'status', {'state': 'pause', 'volume': '59', 'elapsed': '12.000', 'duration': '240.000', 'songid': '29'})
+    t += 2.0
+    at(t, 'status', {'state': 'play', 'volume': '59', 'elapsed': '12.000', 'duration': '240.000', 'songid': '29'})
+    recorder.close()
+
+
+def bench_replay(args):
+    """Replay a trace into an offscreen display and report frames and hashes."""
+    path = args.trace
+    if path is None:
+        path = os.path.join(tempfile.mkdtemp(prefix='tft-bench-'), 'synthetic.jsonl.gz')
+        synthetic_trace(path)
+    tft.COVER_CACHE_DIR = os.path.join(tempfile.mkdtemp(prefix='tft-bench-'), 'covers')
+    tft.stats.reset()
+    start = time.perf_counter()
+    frames = tft.replay_trace(path, args.speed)
+    elapsed = time.perf_counter() - start
+    combined = hashlib.blake2b(digest_size=8)
+    for frame in frames:
+        combined.update(frame[3].encode())
+    passes = [frame[1] / 1000 for frame in frames]
+    print('Replay of {} ({:.1f} s recorded, replayed in {:.1f} s)'.format(
+        'synthetic trace' if args.trace is None else args.trace, frames[-1][0] if frames else 0.0, elapsed))
+    print('  {:>8} frames'.format(len(frames)))
+    if passes:
+        print('  {:>8.2f} ms p50  {:>8.2f} ms p90  {:>8.2f} ms p99  {:>8.2f} ms max per frame'.format(
+            percentile_ms(passes, 50), percentile_ms(passes, 90), percentile_ms(passes, 99), max(passes) * 1000))
+    print('  {:>8.0f} SPI bytes/frame'.format(sum(frame[2] for frame in frames) / max(len(frames), 1)))
+    print('  {} combined frame hash'.format(combined.hexdigest()))
+    if args.hashes:
+        with open(args.hashes, 'w') as out:
+            for seconds, ms, sent, digest in frames:
+                out.write('{:.3f} {} {}\n'.format(seconds, digest, sent))
+        print('  frame hashes written to ' + args.hashes)
+
+
+BENCHMARKS = {
+    'conversion': lambda args: bench_conversion(args.frames),
+    'loop': bench_loop,
+    'covers': bench_covers,
+    'buttons': bench_buttons,
+    'replay': bench_replay,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='TFT-MoodeCoverArt benchmarks')
+    parser.add_argument('benchmarks', nargs='*', help='benchmarks to run: ' + ', '.join(sorted(BENCHMARKS)))
+    parser.add_argument('--frames', type=int, default=100, help='frames per conversion measurement')
+    parser.add_argument('--seconds', type=float, default=10.0, help='duration of the loop benchmark')
+    parser.add_argument('--screens', type=int, default=1, help='display/player pairs in the loop benchmark')
+    parser.add_argument('--panel', default='240x240', help='panel size of the loop benchmark, e.g. 320x240')
+    parser.add_argument('--rotation', type=int, default=0, help='display rotation of the loop benchmark')
+    parser.add_argument('--record', help='record the loop benchmark to this trace file')
+    parser.add_argument('--trace', help='trace to replay (default: a synthetic one)')
+    parser.add_argument('--speed', type=float, default=0.0, help='replay speed, 0 = as fast as possible')
+    parser.add_argument('--hashes', help='write the replayed frame hashes to this file')
+    parser.add_argument('--presses', type=int, default=12, help='button presses for the buttons benchmark')
+    parser.add_argument('--corpus', help='directory of audio files for the covers benchmark')
+    parser.add_argument('--count', type=int, default=5, help='generated corpus size if no --corpus is given')
+    parser.add_argument('--art-size', type=int, default=3000, help='embedded art size of the generated corpus')
+    args = parser.parse_args()
+    for name in args.benchmarks or sorted(BENCHMARKS):
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark: ' + name)
+        BENCHMARKS[name](args)
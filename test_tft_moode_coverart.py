@@ -0,0 +1,207 @@
+"""Behavioural checks for the display hot path of tft_moode_coverart.
+
+These run without display hardware or MPD:
+
+    python3 -m pytest -q
+"""
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import tft_moode_coverart as tft
+
+
+def memory_display(width=240, height=240, rotation=0):
+    display = tft.create_display(backend='memory', width=width, height=height, rotation=rotation,
+                                 offset_left=0, offset_top=0)
+    display.begin()
+    return display
+
+
+def noise(size, seed=0):
+    pixels = np.random.default_rng(seed).integers(0, 256, (size[1], size[0], 3), dtype=np.uint8)
+    return Image.fromarray(pixels, 'RGB')
+
+
+def test_damage_merges_nearby_rows():
+    frames = tft.DamageTracker(memory_display(), merge_gap=8)
+    frames.previous = np.zeros((240, 240), dtype='>u2')
+    frame = frames.previous.copy()
+    frame[10:13, 20:30] = 1
+    frame[16:19, 50:60] = 1
+    frame[100, 5] = 1
+    # rows 10-18 are one band spanning both changes, row 100 is too far away
+    assert frames.regions(frame) == [(20, 10, 59, 18), (5, 100, 5, 100)]
+    assert frames.regions(frames.previous.copy()) == []
+
+
+def test_damage_sends_full_frame_when_most_changed():
+    frames = tft.DamageTracker(memory_display(), full_ratio=0.6)
+    frames.previous = np.zeros((240, 240), dtype='>u2')
+    frame = frames.previous.copy()
+    frame[:200, :] = 1
+    assert frames.regions(frame) == [(0, 0, 239, 239)]
+    frames.reset()
+    assert frames.regions(frame) == [(0, 0, 239, 239)]
+
+
+def test_damage_updates_match_full_frame():
+    display = memory_display(320, 240, rotation=90)
+    frames = tft.DamageTracker(display)
+    size = display.geometry.size
+    first = noise(size)
+    assert frames.display(first) == 320 * 240 * 2
+    second = first.copy()
+    second.paste((255, 0, 0), (30, 40, 90, 60))
+    sent = frames.display(second)
+    assert 0 < sent < 320 * 240 * 2
+    assert np.array_equal(display.buffer, tft.image_to_rgb565(second, 90))
+    # an identical frame sends nothing
+    assert frames.display(second.copy()) == 0
+
+
+def test_rotated_panel_slice_matches_full_conversion():
+    box = (13, 7, 101, 59)
+    for rotation in (0, 90, 180, 270):
+        size = tft.Geometry(320, 240, rotation, 0, 0).size
+        image = noise(size, rotation)
+        full = tft.image_to_rgb565(image, rotation)
+        rows, cols = tft.panel_slice(box, rotation, size)
+        assert np.array_equal(full[rows, cols], tft.image_to_rgb565(image.crop(box), rotation)), rotation
+
+
+def test_framebuffer_layer_matches_full_conversion():
+    box = (30, 40, 90, 75)
+    for rotation in (0, 90, 180, 270):
+        size = tft.Geometry(320, 240, rotation, 0, 0).size
+        background = noise(size, rotation)
+        image = background.copy()
+        image.paste(noise((box[2] - box[0], box[3] - box[1]), 9), box[:2])
+        framebuffer = tft.RGB565Framebuffer(size, rotation)
+        expected = tft.image_to_rgb565(image, rotation)
+        assert np.array_equal(framebuffer.convert(image), expected), rotation
+        # background converted once, only the drawn box converted per frame;
+        # boxes reaching past the frame are clipped
+        layer = ('background', background, [box, (size[0] - 5, 0, size[0] + 20, 10)])
+        assert np.array_equal(framebuffer.convert(image, layer), expected), rotation
+
+
+SPEC = [
+    {'text': 'title', 'top': 105, 'size': 30},
+    {'bar': 'volume', 'top': 184, 'height': 9, 'left': 5, 'right': 34},
+    {'bar': 'time', 'top': 222, 'height': 13, 'left': 5, 'right': 5},
+]
+
+
+def test_layout_overlay_hides_ops_but_keeps_bands():
+    square = tft.Geometry(240, 240, 0, 0, 0)
+    full = tft.compile_layout(SPEC, overlay=2, timebar=1, shade=0, geometry=square)
+    assert [op.name for op in full.ops] == ['title', 'volume', 'time']
+    assert full.timebar is full.ops[2]
+    assert full.timebar.track == (5, 222, 235, 234)
+    no_timebar = tft.compile_layout(SPEC, overlay=2, timebar=0, shade=0, geometry=square)
+    assert [op.name for op in no_timebar.ops] == ['title', 'volume']
+    assert no_timebar.timebar is None
+    artwork = tft.compile_layout(SPEC, overlay=3, timebar=1, shade=0, geometry=square)
+    assert artwork.ops == ()
+    # cover analysis is shared between overlay settings
+    assert artwork.bands == full.bands == no_timebar.bands
+
+
+def test_layout_anchors_lower_elements_to_bottom():
+    tall = tft.compile_layout(SPEC, overlay=2, timebar=1, shade=0, geometry=tft.Geometry(320, 240, 90, 0, 0))
+    title, volume, timebar = tall.ops
+    assert title.top == 105
+    assert volume.track == (5, 264, 206, 272)
+    assert timebar.box == (0, 302, 240, 315)
+
+
+def test_layout_rejects_unknown_elements():
+    with pytest.raises(ValueError):
+        tft.compile_layout([{'bar': 'bass', 'top': 10}], geometry=tft.Geometry(240, 240, 0, 0, 0))
+
+
+def test_clock_interpolates_while_playing():
+    clock = tft.PlaybackClock()
+    clock.update({'state': 'play', 'elapsed': '10.0', 'duration': '60.0'}, 100.0)
+    assert clock.position(102.5) == 12.5
+    assert clock.status({'state': 'play', 'elapsed': '10.0'}, 102.5)['elapsed'] == '12.500'
+    # never runs past the end of the track
+    assert clock.position(500.0) == 60.0
+
+
+def test_clock_holds_position_across_pause_and_seek():
+    clock = tft.PlaybackClock()
+    clock.update({'state': 'play', 'elapsed': '10.0', 'duration': '60.0'}, 100.0)
+    clock.update({'state': 'pause', 'elapsed': '13.0', 'duration': '60.0'}, 103.0)
+    assert clock.position(200.0) == 13.0
+    assert clock.next_change(200.0, 230) is None
+    # seek while playing restarts interpolation from the new position
+    clock.update({'state': 'play', 'elapsed': '45.0', 'duration': '60.0'}, 201.0)
+    assert clock.position(203.0) == 47.0
+
+
+def test_clock_next_change_is_next_pixel_step():
+    clock = tft.PlaybackClock()
+    clock.update({'state': 'play', 'elapsed': '0.0', 'duration': '100.0'}, 0.0)
+    # 100 s over 200 pixels: one step every 0.5 s
+    assert abs(clock.next_change(0.2, 200) - 0.5) < 1e-9
+    # streams without a duration have a static bar
+    clock.update({'state': 'play', 'elapsed': '5.0'}, 0.0)
+    assert clock.next_change(1.0, 200) is None
+
+
+def test_status_without_elapsed_is_unchanged():
+    clock = tft.PlaybackClock()
+    status = {'state': 'stop'}
+    assert clock.status(status, 10.0) is status
+
+
+SONG = 'file=Artist/Album/01.flac\nartist=Artist\nalbum=Album\ntitle={}\ncoverurl=/coverart.php\n'
+
+
+def test_metadata_partial_write_keeps_last_record(tmp_path):
+    path = tmp_path / 'currentsong.txt'
+    path.write_text(SONG.format('First'))
+    watcher = tft.MetadataWatcher(str(path))
+    try:
+        assert watcher.read()['title'] == 'First'
+        # Moode truncates and rewrites: an empty or unterminated file is
+        # still being written
+        path.write_text('')
+        assert watcher.read()['title'] == 'First'
+        path.write_text(SONG.format('Second track').rstrip('\n'))
+        assert watcher.read()['title'] == 'First'
+        path.write_text(SONG.format('Second track'))
+        assert watcher.read()['title'] == 'Second track'
+    finally:
+        watcher.close()
+
+
+def test_metadata_rejects_read_racing_a_write(tmp_path, monkeypatch):
+    path = tmp_path / 'currentsong.txt'
+    path.write_text(SONG.format('First'))
+    watcher = tft.MetadataWatcher(str(path))
+    try:
+        watcher.read()
+        path.write_text(SONG.format('Second'))
+
+        def racing_open(filename, *args, **kwargs):
+            # the file grows between our stat and the end of the read
+            metafile = open(filename, *args, **kwargs)
+            with open(filename, 'a') as writer:
+                writer.write('duration=200\n')
+            return metafile
+
+        monkeypatch.setattr(tft, 'open', racing_open, raising=False)
+        assert watcher.read()['title'] == 'First'
+        monkeypatch.delattr(tft, 'open')
+        meta = watcher.read()
+        assert (meta['title'], meta['duration']) == ('Second', '200')
+    finally:
+        watcher.close()
+
+
+def test_metadata_missing_file(tmp_path):
+    assert tft.getMoodeMetadata(str(tmp_path / 'missing.txt')) == {'source': 'library'}
@@ -15,21 +15,33 @@ Version: 0.0.9
 License: See LICENSE file
 """
 
-from PIL import Image, ImageDraw, ImageColor, ImageFont, ImageStat
-import subprocess
+from PIL import Image, ImageDraw, ImageColor, ImageFont, ImageFilter, ImageOps, PngImagePlugin
 import time
 import musicpd
 import os
 import os.path
 from os import path
-import RPi.GPIO as GPIO
-from mediafile import MediaFile
 from io import BytesIO
-from numpy import mean 
-import st7789
-from PIL import ImageFilter
+import numpy as np
 import yaml
 import urllib.parse
+import asyncio
+import ctypes
+import ctypes.util
+import functools
+import json
+import gzip
+import zlib
+import struct
+import hashlib
+import threading
+import socket
+import signal
+import traceback
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from types import MappingProxyType
 
 # set default config for pirate audio
 
@@ -49,7 +61,89 @@ PPBUTTON=0
 PAUSEBLANK=0
 SCROLLSPEED=2
 ROTATION=0
+# panel size as the driver addresses it, and its offset in the controller RAM
+WIDTH=240
+HEIGHT=240
+OFFSET_LEFT=0
+OFFSET_TOP=0
 SPI_SPEED=100000000
+PARTIAL_UPDATE=1
+DISPLAY_BACKEND='st7789'
+
+# screen layout, drawn in this order (see compile_layout())
+LAYOUT=[
+    {'text': 'artist', 'top': 7, 'size': 24},
+    {'text': 'album', 'top': 35, 'size': 20},
+    {'text': 'title', 'top': 105, 'size': 30},
+    {'bar': 'volume', 'top': 184, 'height': 9, 'left': 5, 'right': 34},
+    {'bar': 'time', 'top': 222, 'height': 13, 'left': 5, 'right': 5},
+]
+
+# MPD and Moode locations
+MPD_HOST=None
+MPD_PORT=None
+MPD_START_TIMEOUT=30.0
+# seconds a connect or command may take before the player is treated as gone
+MPD_TIMEOUT=5
+METADATA_FILE='/var/local/www/currentsong.txt'
+# extra display/player pairs; empty drives one display from the settings above
+SCREENS=[]
+MUSIC_DIR='/var/lib/mpd/music/'
+WWW_DIR='/var/local/www/'
+
+# on-disk cover art cache
+COVER_CACHE_DIR='cache/covers'
+COVER_CACHE_ENTRIES=1000
+COVER_CACHE_MB=64
+ASSET_CACHE_DIR='cache/assets'
+PREFETCH=1
+PREFETCH_WORKERS=1
+
+# folder cover images, matched case-insensitively in priority order
+COVER_NAMES=('cover', 'folder')
+COVER_EXTENSIONS=('jpg', 'jpeg', 'png', 'tif', 'tiff')
+COVER_DIRS=512
+# largest cover (in pixels, after JPEG scaling) that is decoded at all
+COVER_MAX_PIXELS=16000000
+
+# Pirate Audio buttons (BCM pin: action), active low
+BUTTONS=0
+BUTTON_PINS={5: 'play_pause', 6: 'volume_down', 16: 'next', 24: 'volume_up'}
+BUTTON_BOUNCE=150
+VOLUME_STEP=5
+
+# memory budget (bounded=1 for Pi Zero class boards)
+MEMORY_BOUNDED=0
+LAYER_CACHE_SIZE=4
+SPRITE_CACHE_SIZE=8
+
+# hot path metrics export
+METRICS=0
+METRICS_TEXTFILE=''
+METRICS_SOCKET=''
+METRICS_INTERVAL=10.0
+
+# input trace recording for offline replay ('' disables, {screen} is the screen name)
+TRACE_RECORD=''
+TRACE_FLUSH=5.0
+
+# MPD connection handling
+MPD_SUBSYSTEMS=('player', 'mixer', 'options', 'playlist')
+MPD_IDLE_TIMEOUT=1.0
+# seconds between status refreshes that correct the interpolated play position
+MPD_RESYNC=30.0
+MPD_BACKOFF_MIN=0.5
+MPD_BACKOFF_MAX=30.0
+FRAME_TIME=0.05
+FPS=20
+IDLE_MAX=60.0
+
+# inotify flags for the currentsong.txt watcher (IN_CLOSE_WRITE | IN_MOVED_TO)
+INOTIFY_MASK=0x00000008 | 0x00000080
+INOTIFY_Q_OVERFLOW=0x00004000
+INOTIFY_EVENT=struct.Struct('iIII')
+# filesystems where inotify misses writes made by other hosts
+REMOTE_FILESYSTEMS=('nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', 'fuse.sshfs', '9p', 'ceph', 'glusterfs', 'afs')
 
 confile = 'config.yml'
 
@@ -68,243 +162,3025 @@ if path.exists(confile):
         PAUSEBLANK = displayConf.get('pauseblank', PAUSEBLANK)
         SCROLLSPEED = displayConf.get('scrollspeed', SCROLLSPEED)
         ROTATION = displayConf.get('rotation', ROTATION)
+        WIDTH = displayConf.get('width', WIDTH)
+        HEIGHT = displayConf.get('height', HEIGHT)
+        OFFSET_LEFT = displayConf.get('offset_left', OFFSET_LEFT)
+        OFFSET_TOP = displayConf.get('offset_top', OFFSET_TOP)
         SPI_SPEED = displayConf.get('spi_speed_hz', SPI_SPEED) 
+        PARTIAL_UPDATE = displayConf.get('partial_update', PARTIAL_UPDATE)
+        FPS = displayConf.get('fps', FPS)
+        DISPLAY_BACKEND = displayConf.get('backend', DISPLAY_BACKEND)
+        mpdConf = data.get('mpd', {})
+        MPD_HOST = mpdConf.get('host', MPD_HOST)
+        MPD_PORT = mpdConf.get('port', MPD_PORT)
+        MPD_START_TIMEOUT = mpdConf.get('start_timeout', MPD_START_TIMEOUT)
+        MPD_TIMEOUT = mpdConf.get('timeout', MPD_TIMEOUT)
+        MPD_RESYNC = mpdConf.get('resync', MPD_RESYNC)
+        METADATA_FILE = mpdConf.get('metadata', METADATA_FILE)
+        MUSIC_DIR = mpdConf.get('music_dir', MUSIC_DIR)
+        SCREENS = data.get('screens', SCREENS) or []
+        LAYOUT = data.get('layout', LAYOUT) or LAYOUT
+        cacheConf = data.get('cache', {})
+        COVER_CACHE_DIR = cacheConf.get('coverdir', COVER_CACHE_DIR)
+        COVER_CACHE_ENTRIES = cacheConf.get('max_entries', COVER_CACHE_ENTRIES)
+        COVER_CACHE_MB = cacheConf.get('max_mb', COVER_CACHE_MB)
+        ASSET_CACHE_DIR = cacheConf.get('assetdir', ASSET_CACHE_DIR)
+        PREFETCH = cacheConf.get('prefetch', PREFETCH)
+        PREFETCH_WORKERS = cacheConf.get('prefetch_workers', PREFETCH_WORKERS)
+        coversConf = data.get('covers', {})
+        COVER_NAMES = tuple(coversConf.get('names', COVER_NAMES))
+        COVER_EXTENSIONS = tuple(coversConf.get('extensions', COVER_EXTENSIONS))
+        COVER_DIRS = coversConf.get('max_dirs', COVER_DIRS)
+        COVER_MAX_PIXELS = coversConf.get('max_pixels', COVER_MAX_PIXELS)
+        buttonsConf = data.get('buttons', {})
+        BUTTONS = buttonsConf.get('enabled', BUTTONS)
+        BUTTON_PINS = {int(pin): action for pin, action in buttonsConf.get('pins', BUTTON_PINS).items()}
+        BUTTON_BOUNCE = buttonsConf.get('bouncetime', BUTTON_BOUNCE)
+        VOLUME_STEP = buttonsConf.get('volume_step', VOLUME_STEP)
+        memoryConf = data.get('memory', {})
+        MEMORY_BOUNDED = memoryConf.get('bounded', MEMORY_BOUNDED)
+        metricsConf = data.get('metrics', {})
+        METRICS = metricsConf.get('enabled', METRICS)
+        METRICS_TEXTFILE = metricsConf.get('textfile', METRICS_TEXTFILE)
+        METRICS_SOCKET = metricsConf.get('socket', METRICS_SOCKET)
+        METRICS_INTERVAL = metricsConf.get('interval', METRICS_INTERVAL)
+        traceConf = data.get('trace', {})
+        TRACE_RECORD = traceConf.get('record', TRACE_RECORD) or ''
+
+
+if MEMORY_BOUNDED == 1:
+    # keep only what the current and the next frame need
+    LAYER_CACHE_SIZE = 2
+    SPRITE_CACHE_SIZE = 4
+    COVER_MAX_PIXELS = min(COVER_MAX_PIXELS, 4000000)
+
+     
+# Display is created by create_display() when the script starts
+disp = None
+# GPIO module for the buttons; None imports RPi.GPIO when buttons are enabled
+gpio = None
+
+
+class Geometry(namedtuple('Geometry', ['width', 'height', 'rotation', 'offset_left', 'offset_top'])):
+    """Size, rotation and offsets of one display.
+
+    ``width`` and ``height`` are the panel as the driver addresses it; frames
+    are drawn at ``size``, which swaps them for 90 and 270 degree rotation.
+    Layout coordinates are designed for a REFERENCE x REFERENCE screen and
+    scaled uniformly by ``scale``, with positions in the lower half anchored
+    to the bottom edge, so on taller or wider panels the extra space opens
+    up in the middle.
+
+    Example:
+        >>> Geometry(320, 240, 90, 0, 0).size
+        (240, 320)
+    """
+
+    __slots__ = ()
+    REFERENCE = 240
+
+    @property
+    def size(self):
+        if (self.rotation // 90) % 2 == 1:
+            return (self.height, self.width)
+        return (self.width, self.height)
+
+    @property
+    def scale(self):
+        return min(self.size) / self.REFERENCE
+
+    def scaled(self, value):
+        """Scale a reference length (font size, margin, bar height)."""
+        return max(1, int(round(value * self.scale)))
+
+    def y(self, value):
+        """Map a reference row, anchored to the nearest of top and bottom."""
+        if value < self.REFERENCE / 2:
+            return int(round(value * self.scale))
+        return self.size[1] - int(round((self.REFERENCE - value) * self.scale))
+
+
+GEOMETRY = Geometry(WIDTH, HEIGHT, ROTATION, OFFSET_LEFT, OFFSET_TOP)
+FONT='Roboto-Medium.ttf'
+
+
+@functools.lru_cache(maxsize=None)
+def load_font(name, size):
+    """Load a font from the fonts directory once per name and size."""
+    return ImageFont.truetype(script_path + '/fonts/' + name, size)
+
+
+if PPBUTTON == 1:
+    # reversed play and pause icons
+    play_icon_file, pause_icon_file = 'controls-pause', 'controls-play'
+else:
+    # original play and pause icons
+    play_icon_file, pause_icon_file = 'controls-play', 'controls-pause'
+
+# overlay icons by name (see overlay_icon()), loaded on first use
+overlay_icons = {
+    'play': play_icon_file + '.png',
+    'play_dark': play_icon_file + '-dark.png',
+    'pause': pause_icon_file + '.png',
+    'pause_dark': pause_icon_file + '-dark.png',
+    'vol': 'controls-vol.png',
+    'vol_dark': 'controls-vol-dark.png',
+}
+
+# backgrounds for sources without cover art, loaded on first use
+source_backgrounds = {
+    'bluetooth': 'bta.png',
+    'airplay': 'airplay.png',
+    'input': 'jack.png',
+    'spotify': 'spotify.png',
+    'squeeze': 'squeeze.png',
+}
+
+
+def fit_asset(image, size, anchored=False):
+    """Scale an image to a frame size.
+
+    Full frame artwork is scaled to cover the frame and centre cropped.
+    Control overlays (``anchored``) are scaled uniformly to the shorter side
+    and their quadrants pinned to the matching corners, so icons keep their
+    shape and stay at the screen edges next to the layout's bars.
+
+    Args:
+        image (PIL.Image): RGBA source image
+        size (tuple): Frame size (width, height)
+        anchored (bool): Pin quadrants to the corners instead of cropping
+
+    Returns:
+        PIL.Image: RGBA image of the given size
+    """
+    if (not anchored) or (size[0] == size[1]):
+        return ImageOps.fit(image, size, Image.Resampling.LANCZOS)
+    side = min(size)
+    square = image.resize((side, side), Image.Resampling.LANCZOS)
+    layer = Image.new('RGBA', size, (0, 0, 0, 0))
+    half = side // 2
+    for x0, x1, dx in ((0, half, 0), (half, side, size[0] - side)):
+        for y0, y1, dy in ((0, half, 0), (half, side, size[1] - side)):
+            layer.paste(square.crop((x0, y0, x1, y1)), (x0 + dx, y0 + dy))
+    return layer
+
+
+@functools.lru_cache(maxsize=2 if MEMORY_BOUNDED == 1 else None)
+def load_asset(name, size=None):
+    """Load an image from the images directory at a frame size.
+
+    Assets are only loaded when a configuration or source actually needs
+    them. In bounded memory mode only the most recent two are kept. Each
+    asset is built once per frame size (see fit_asset()) and the pixels are
+    kept in ASSET_CACHE_DIR as raw RGBA, keyed by the asset's mtime and size
+    and the frame size, so later starts skip the PNG decode and LANCZOS
+    resize and frames never resample.
+
+    Args:
+        name (str): File name below images/
+        size (tuple): Frame size (defaults to the configured display)
+
+    Returns:
+        PIL.Image: RGBA image of the frame size
+    """
+    size = size or GEOMETRY.size
+    # control overlays: icons pinned to the corners rather than cropped
+    anchored = name.startswith('controls-')
+    source = script_path + '/images/' + name
+    cached = None
+    try:
+        st = os.stat(source)
+        digest = hashlib.sha1(repr((name, st.st_mtime_ns, st.st_size, size, anchored)).encode()).hexdigest()
+        cached = os.path.join(script_path, ASSET_CACHE_DIR, digest + '.rgba')
+        with open(cached, 'rb') as raw:
+            data = raw.read()
+        if len(data) == size[0] * size[1] * 4:
+            return Image.frombytes('RGBA', size, data)
+    except OSError:
+        pass
+    asset = fit_asset(Image.open(source).convert("RGBA"), size, anchored)
+    if cached is not None:
+        try:
+            os.makedirs(os.path.dirname(cached), exist_ok=True)
+            with open(cached + '.tmp', 'wb') as raw:
+                raw.write(asset.tobytes())
+            os.replace(cached + '.tmp', cached)
+        except OSError:
+            pass
+    return asset
+
+
+def memory_usage():
+    """Return the current and peak resident memory of the process in bytes.
+
+    Returns:
+        tuple: (rss, peak_rss); values are 0 if they cannot be determined
+    """
+    rss = peak = 0
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    rss = int(line.split()[1]) * 1024
+                elif line.startswith('VmHWM:'):
+                    peak = int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return rss, peak
+
+
+def memory_report(signum=None, frame=None):
+    """Print current and peak memory use; installed as the SIGUSR1 handler.
+
+    Example:
+        kill -USR1 $(pidof -x tft_moode_coverart.py)
+    """
+    rss, peak = memory_usage()
+    print('memory: rss {:.1f} MB, peak {:.1f} MB, assets loaded {}'.format(
+        rss / 1048576, peak / 1048576, load_asset.cache_info().currsize))
+
+
+def terminate(signum=None, frame=None):
+    """Shut down like on Ctrl-C; installed as the SIGTERM handler.
+
+    systemd stops the service with SIGTERM. Raising KeyboardInterrupt makes
+    asyncio cancel the display loops, whose finally clauses release GPIO,
+    MPD sockets, the SPI thread and trace files before the panels are reset.
+    """
+    raise KeyboardInterrupt
+
+
+def create_display(backend=None, rotation=None, mode=None, port=0, cs='front', dc=9, backlight=13, rst=None,
+                   width=None, height=None, offset_left=None, offset_top=None):
+    """Create and initialise the display backend.
+
+    The defaults match the Pirate Audio wiring; the keyword arguments are the
+    ``display`` settings of an entry in ``screens`` (see configured_screens()).
+
+    Args:
+        backend (str): 'st7789' for the SPI panel, 'memory' for an in-memory
+                       framebuffer (defaults to the configured backend)
+        rotation (int): Display rotation (defaults to the configured rotation)
+        mode (int): 3 for boards without a cs pin (defaults to the configured mode)
+        port (int): SPI port
+        cs (str or int): Chip select, 'front' (GPIO 8), 'back' (GPIO 7) or a number
+        dc (int): Data/command GPIO
+        backlight (int): Backlight GPIO
+        rst (int): Reset GPIO, 22 when mode is 3
+        width (int): Panel width, e.g. 320 for 320x240 panels
+        height (int): Panel height
+        offset_left (int): Column offset of the panel in the controller RAM
+        offset_top (int): Row offset of the panel in the controller RAM
+
+    Returns:
+        Display object with the st7789.ST7789 interface and a ``geometry``
+        attribute (see Geometry)
+    """
+    backend = backend or DISPLAY_BACKEND
+    geometry = Geometry(
+        WIDTH if width is None else width,
+        HEIGHT if height is None else height,
+        ROTATION if rotation is None else rotation,
+        OFFSET_LEFT if offset_left is None else offset_left,
+        OFFSET_TOP if offset_top is None else offset_top,
+    )
+    mode = MODE if mode is None else mode
+    if backend == 'memory':
+        display = MemoryDisplay(geometry.width, geometry.height, rotation=geometry.rotation)
+    else:
+        import st7789
+        # Standard SPI connections for ST7789
+        if cs == 'front':
+            cs = st7789.BG_SPI_CS_FRONT  # GPIO 8, Physical pin 24
+        elif cs == 'back':
+            cs = st7789.BG_SPI_CS_BACK  # GPIO 7, Physical pin 26
+        if (rst is None) and (mode == 3):
+            rst = 22
+        # Create ST7789 LCD display class.
+        # Frames are rotated by DamageTracker; the driver only accepts 90/270
+        # on square panels, and its own rotation is not used for drawing
+        display = st7789.ST7789(
+            port=port,
+            cs=cs,
+            dc=dc,
+            rst=rst,
+            backlight=backlight,
+            width=geometry.width,
+            height=geometry.height,
+            rotation=geometry.rotation if geometry.width == geometry.height else 0,
+            offset_left=geometry.offset_left,
+            offset_top=geometry.offset_top,
+            spi_speed_hz=SPI_SPEED
+        )
+
+    # Initialize display.
+    display.begin()
+    display.geometry = geometry
+    return display
+
+
+def display_geometry(display):
+    """Return the Geometry of a display from create_display().
+
+    Displays created elsewhere (e.g. a plain st7789.ST7789) are assumed to
+    match the configured size, with their own rotation.
+    """
+    geometry = getattr(display, 'geometry', None)
+    if geometry is None:
+        geometry = GEOMETRY._replace(rotation=getattr(display, '_rotation', ROTATION))
+    return geometry
+
+
+Screen = namedtuple('Screen', ['name', 'display', 'host', 'port', 'metadata', 'music_dir'])
+
+
+def configured_screens():
+    """Build the display/player pairs to drive.
+
+    Without a ``screens`` list in config.yml there is a single screen: the
+    module level ``disp`` (see create_display()) showing the player from the
+    ``mpd`` settings. Otherwise each entry names its own MPD endpoint,
+    metadata file, music directory (where that player's library is mounted
+    locally) and display; missing settings fall back to the ``mpd`` and
+    ``display`` sections.
+
+    Returns:
+        list: Screen tuples, the first one receives the button presses
+
+    Example:
+        >>> [screen.name for screen in configured_screens()]
+        ['front', 'back']
+    """
+    if not SCREENS:
+        return [Screen('default', disp, MPD_HOST, MPD_PORT, METADATA_FILE, MUSIC_DIR)]
+    screens = []
+    for index, conf in enumerate(SCREENS):
+        screens.append(Screen(
+            conf.get('name', 'screen{}'.format(index)),
+            create_display(**conf.get('display', {})),
+            conf.get('host', MPD_HOST),
+            conf.get('port', MPD_PORT),
+            conf.get('metadata', METADATA_FILE),
+            conf.get('music_dir', MUSIC_DIR),
+        ))
+    return screens
+
+
+class MemoryDisplay:
+    """In-memory stand-in for the ST7789 driver.
+
+    Implements the parts of the st7789.ST7789 interface used by this script
+    and keeps the panel contents in a NumPy RGB565 buffer, so the display loop
+    can run without SPI hardware (benchmarks, development machines). Window
+    writes are applied exactly like the controller would apply them.
+
+    Args:
+        width (int): Panel width in pixels
+        height (int): Panel height in pixels
+        rotation (int): Display rotation in degrees (0, 90, 180, 270)
+
+    Attributes:
+        frames (int): Number of completed window/frame writes
+        bytes (int): Pixel bytes received
+        backlight (bool): Current backlight state
+    """
+
+    def __init__(self, width=240, height=240, rotation=0):
+        self.width = width
+        self.height = height
+        self._rotation = rotation
+        self.buffer = np.zeros((height, width), dtype='>u2')
+        self.window = (0, 0, width - 1, height - 1)
+        self.pending = bytearray()
+        self.frames = 0
+        self.bytes = 0
+        self.backlight = False
+
+    def begin(self):
+        self.backlight = True
+
+    def reset(self):
+        self.buffer[:] = 0
+
+    def set_backlight(self, value):
+        self.backlight = bool(value)
+
+    def set_window(self, x0=0, y0=0, x1=None, y1=None):
+        x1 = self.width - 1 if x1 is None else x1
+        y1 = self.height - 1 if y1 is None else y1
+        self.window = (x0, y0, x1, y1)
+        self.pending = bytearray()
+
+    def data(self, data):
+        self.pending.extend(data)
+        self.bytes += len(data)
+        x0, y0, x1, y1 = self.window
+        rows, cols = y1 - y0 + 1, x1 - x0 + 1
+        if len(self.pending) == rows * cols * 2:
+            self.buffer[y0:y1 + 1, x0:x1 + 1] = np.frombuffer(bytes(self.pending), dtype='>u2').reshape(rows, cols)
+            self.pending = bytearray()
+            self.frames += 1
+
+    def command(self, data):
+        pass
+
+    def display(self, image):
+        self.set_window()
+        self.data(image_to_rgb565(image, self._rotation).astype('>u2').tobytes())
+
+
+class StageStats:
+    """Rolling timing samples and counters for the display hot path.
+
+    Each stage (MPD round trip, metadata read, cover load, compose, SPI
+    transfer, ...) keeps its most recent durations so percentiles can be
+    reported without unbounded memory, plus a running count and sum.
+    Counters accumulate totals such as frames rendered or bytes sent, gauges
+    hold the latest value of a setting or level. Safe to use from several
+    threads.
+
+    Args:
+        window (int): Number of samples kept per stage
+
+    Example:
+        >>> with stats.time('compose'):
+        ...     compose_frame()
+        >>> stats.percentiles('compose')
+    """
+
+    def __init__(self, window=1000):
+        self.window = window
+        self.samples = {}
+        self.totals = {}
+        self.counters = {}
+        self.gauges = {}
+        self.lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self.lock:
+            samples = self.samples.get(stage)
+            if samples is None:
+                samples = self.samples[stage] = deque(maxlen=self.window)
+                self.totals[stage] = [0, 0.0]
+            samples.append(seconds)
+            totals = self.totals[stage]
+            totals[0] += 1
+            totals[1] += seconds
+
+    @contextmanager
+    def time(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def timed(self, stage):
+        """Decorator timing every call of a function as a stage."""
+        def decorate(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.time(stage):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorate
+
+    def count(self, counter, amount=1):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def percentiles(self, stage, points=(50, 90, 99)):
+        """Return {point: seconds} for a stage's recent samples (empty if none)."""
+        with self.lock:
+            samples = sorted(self.samples.get(stage, ()))
+        if not samples:
+            return {}
+        return {p: samples[min(len(samples) - 1, int(len(samples) * p / 100))] for p in points}
+
+    def reset(self):
+        with self.lock:
+            self.samples.clear()
+            self.totals.clear()
+            self.counters.clear()
+            self.gauges.clear()
+
+    def exposition(self, prefix='tft'):
+        """Render all statistics in the Prometheus text exposition format.
+
+        Stages become a summary with rolling p50/p90/p99 quantiles, counters
+        become ``<prefix>_<name>_total`` and gauges ``<prefix>_<name>``.
+
+        Args:
+            prefix (str): Metric name prefix
+
+        Returns:
+            str: Metrics text, one sample per line
+        """
+        with self.lock:
+            stages = {stage: (sorted(samples), tuple(self.totals[stage]))
+                      for stage, samples in self.samples.items()}
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+        lines = [
+            '# HELP {}_stage_seconds Time spent in each display loop stage'.format(prefix),
+            '# TYPE {}_stage_seconds summary'.format(prefix),
+        ]
+        for stage, (samples, (count, total)) in sorted(stages.items()):
+            for point in (50, 90, 99):
+                value = samples[min(len(samples) - 1, int(len(samples) * point / 100))]
+                lines.append('{}_stage_seconds{{stage="{}",quantile="{}"}} {:.6f}'.format(
+                    prefix, stage, point / 100, value))
+            lines.append('{}_stage_seconds_count{{stage="{}"}} {}'.format(prefix, stage, count))
+            lines.append('{}_stage_seconds_sum{{stage="{}"}} {:.6f}'.format(prefix, stage, total))
+        for name, value in sorted(counters.items()):
+            lines.append('# TYPE {}_{}_total counter'.format(prefix, name))
+            lines.append('{}_{}_total {}'.format(prefix, name, value))
+        for name, value in sorted(gauges.items()):
+            lines.append('# TYPE {}_{} gauge'.format(prefix, name))
+            lines.append('{}_{} {}'.format(prefix, name, value))
+        return '\n'.join(lines) + '\n'
+
+
+# Hot path statistics shared by the display loop and the transfer thread
+stats = StageStats()
+
+
+class MetricsExporter:
+    """Publish StageStats in the Prometheus text format.
+
+    Two outputs are supported and may be used together: a text file that is
+    rewritten every interval (for node_exporter's textfile collector), and a
+    local UNIX socket that returns the current metrics to every client that
+    connects, e.g. ``socat - UNIX-CONNECT:/run/tft-moodecoverart.sock``.
+
+    Args:
+        stats (StageStats): Statistics to export
+        textfile (str): Path of the .prom file to write ('' to disable)
+        socket_path (str): Path of the UNIX socket to serve ('' to disable)
+        interval (float): Seconds between text file updates
+
+    Example:
+        >>> exporter = MetricsExporter(stats, textfile='/var/lib/node_exporter/tft.prom')
+        >>> exporter.stop()
+    """
+
+    def __init__(self, stats, textfile='', socket_path='', interval=METRICS_INTERVAL):
+        self.stats = stats
+        self.textfile = textfile
+        self.socket_path = socket_path
+        self.interval = interval
+        self.stopping = threading.Event()
+        self.server = None
+        self.threads = []
+        if socket_path:
+            try:
+                if os.path.exists(socket_path):
+                    os.remove(socket_path)
+                self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self.server.bind(socket_path)
+                self.server.listen(4)
+                self.server.settimeout(1.0)
+            except OSError as e:
+                print("metrics socket unavailable: {}".format(e))
+                self.server = None
+            else:
+                self._start(self._serve)
+        if textfile:
+            self._start(self._write_loop)
+
+    def _start(self, target):
+        thread = threading.Thread(target=target, name='metrics', daemon=True)
+        thread.start()
+        self.threads.append(thread)
+
+    def exposition(self):
+        rss, peak = memory_usage()
+        self.stats.gauge('memory_rss_bytes', rss)
+        self.stats.gauge('memory_peak_bytes', peak)
+        return self.stats.exposition()
+
+    def write(self):
+        """Write the text file atomically so the collector never reads half a file."""
+        try:
+            with open(self.textfile + '.tmp', 'w') as prom:
+                prom.write(self.exposition())
+            os.replace(self.textfile + '.tmp', self.textfile)
+        except OSError:
+            pass
+
+    def _write_loop(self):
+        while not self.stopping.wait(self.interval):
+            self.write()
+        self.write()
+
+    def _serve(self):
+        while not self.stopping.is_set():
+            try:
+                conn, _ = self.server.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+            try:
+                conn.sendall(self.exposition().encode())
+            except OSError:
+                pass
+            finally:
+                conn.close()
+
+    def stop(self):
+        self.stopping.set()
+        for thread in self.threads:
+            thread.join()
+        if self.server is not None:
+            self.server.close()
+            try:
+                os.remove(self.socket_path)
+            except OSError:
+                pass
+
+
+class MPDConnection:
+    """Long-lived MPD client connection with reconnect backoff and idle support.
+
+    A single socket is kept open for the lifetime of the display loop instead of
+    connecting on every pass. While nothing needs to be queried the connection
+    sits in MPD's ``idle`` state, so the loop only wakes when the player, mixer
+    or options change. If MPD goes away the connection is dropped and retried
+    with exponential backoff.
+
+    The blocking musicpd calls run on the event loop's default executor with
+    MPD_TIMEOUT as connect and socket timeout, so a slow or unreachable player
+    only delays its own screen and a dead peer raises instead of hanging.
+
+    Args:
+        host (str): MPD host or socket path (None uses MPD_HOST or the default)
+        port (int): MPD port (None uses MPD_PORT or 6600)
+        subsystems (tuple): MPD idle subsystems that wake the display loop
+
+    Example:
+        >>> mpd = MPDConnection()
+        >>> changed = await mpd.wait(events, 1.0)
+        >>> status = await mpd.status()
+    """
+
+    def __init__(self, host=None, port=None, subsystems=MPD_SUBSYSTEMS):
+        self.host = host
+        self.port = port
+        self.subsystems = subsystems
+        self.client = None
+        self.idling = False
+        self.changes = []
+        self.backoff = MPD_BACKOFF_MIN
+        self.next_attempt = 0.0
+
+    @property
+    def connected(self):
+        return self.client is not None
+
+    @property
+    def retry_at(self):
+        """Monotonic time from which a command can reach MPD (now unless in reconnect backoff)."""
+        now = time.monotonic()
+        return now if self.client is not None else max(now, self.next_attempt)
+
+    @staticmethod
+    async def _io(func, *args):
+        # musicpd is blocking: keep it off the loop that draws every screen
+        return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+    async def connect(self):
+        """Open the connection if it is down and the backoff delay has passed.
+
+        Returns:
+            bool: True if a connection is available
+        """
+        if self.client is not None:
+            return True
+        now = time.monotonic()
+        if now < self.next_attempt:
+            return False
+        client = musicpd.MPDClient()
+        # bound the TCP connect and every read and write after it (hello included)
+        client.mpd_timeout = MPD_TIMEOUT
+        client.socket_timeout = MPD_TIMEOUT
+        try:
+            await self._io(client.connect, self.host, self.port)
+        except (musicpd.MPDError, OSError):
+            self.next_attempt = time.monotonic() + self.backoff
+            self.backoff = min(self.backoff * 2, MPD_BACKOFF_MAX)
+            return False
+        self.client = client
+        self.idling = False
+        self.backoff = MPD_BACKOFF_MIN
+        # anything may have changed while disconnected (e.g. MPD restarted
+        # stopped): report every subsystem so the loop refreshes its status
+        self.changes = list(self.subsystems)
+        return True
+
+    async def wait_ready(self, timeout, max_delay=1.0):
+        """Wait until MPD accepts a connection, e.g. while the system boots.
+
+        Connection attempts start 50 ms apart and back off to max_delay, so a
+        running MPD is found immediately and a starting one within a second
+        of it opening its socket. Other screens keep running meanwhile.
+
+        Args:
+            timeout (float): Seconds to wait before giving up
+            max_delay (float): Longest pause between attempts
+
+        Returns:
+            bool: True once connected, False if MPD did not come up in time
+        """
+        deadline = time.monotonic() + timeout
+        delay = 0.05
+        while True:
+            self.next_attempt = 0.0
+            if await self.connect():
+                return True
+            if time.monotonic() + delay > deadline:
+                return False
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, max_delay)
+
+    def close(self):
+        """Close the connection, ignoring errors from an already dead socket."""
+        if self.client is not None:
+            try:
+                self.client.disconnect()
+            except (musicpd.MPDError, OSError):
+                pass
+        self.client = None
+        self.idling = False
+
+    def _drop(self):
+        # connection failed mid-command: close and schedule a reconnect
+        self.close()
+        self.next_attempt = time.monotonic() + self.backoff
+        self.backoff = min(self.backoff * 2, MPD_BACKOFF_MAX)
+
+    def _command(self, name, args):
+        # executor thread: leave idle mode, then run the command
+        if self.idling:
+            self.idling = False
+            self.changes.extend(self.client.noidle())
+        return getattr(self.client, name)(*args)
+
+    async def command(self, name, *args):
+        """Run a short MPD command, leaving idle mode around it if necessary.
+
+        Args:
+            name (str): MPD command name (e.g. 'status', 'currentsong')
+            *args: Command arguments
+
+        Returns:
+            The command result, or None if MPD is not reachable
+        """
+        if not await self.connect():
+            return None
+        try:
+            return await self._io(self._command, name, args)
+        except (musicpd.MPDError, OSError):
+            self._drop()
+            return None
+
+    async def status(self):
+        """Return MPD status as a dict (empty if MPD is not reachable)."""
+        return await self.command('status') or {}
+
+    async def wait(self, events, timeout):
+        """Wait until MPD reports a change, another loop event fires or the timeout expires.
+
+        Args:
+            events (LoopEvents): Event sources of the display loop
+            timeout (float): Maximum time to wait in seconds
+
+        Returns:
+            list: Changed subsystem names followed by the tags of any other
+                  events that fired (empty on timeout or when disconnected)
+        """
+        if not await self.connect():
+            timeout = max(0.0, min(timeout, self.next_attempt - time.monotonic()))
+            return await events.wait(timeout)
+        if self.changes:
+            changes, self.changes = self.changes, []
+            return changes
+        try:
+            if not self.idling:
+                await self._io(self.client.send_idle, *self.subsystems)
+                self.idling = True
+            fd = self.client.fileno()
+            events.watch(fd, 'mpd')
+            try:
+                fired = await events.wait(timeout)
+            finally:
+                events.unwatch(fd)
+            changes = [tag for tag in fired if tag != 'mpd']
+            if 'mpd' in fired:
+                self.idling = False
+                changes = await self._io(self.client.fetch_idle) + changes
+            return changes
+        except (musicpd.MPDError, OSError):
+            self._drop()
+            return []
+
+
+class LoopEvents:
+    """Wakeup sources of the display loop on an asyncio event loop.
+
+    File descriptors (the MPD idle socket, the currentsong.txt inotify
+    watch) are registered as readers, and other threads (GPIO edge
+    callbacks, cover workers) post tagged events thread-safely. The loop
+    awaits wait() with the time until its next animation frame or timer, so
+    it sleeps until whichever comes first without polling.
+
+    Example:
+        >>> events = LoopEvents(asyncio.get_running_loop())
+        >>> events.watch(watcher.fileno(), 'metadata')
+        >>> fired = await events.wait(0.05)
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.fired = []
+        self.wakeup = asyncio.Event()
+
+    def _fire(self, tag):
+        if tag not in self.fired:
+            self.fired.append(tag)
+        self.wakeup.set()
+
+    def watch(self, fd, tag):
+        """Fire tag whenever fd becomes readable."""
+        self.loop.add_reader(fd, self._fire, tag)
+
+    def unwatch(self, fd):
+        self.loop.remove_reader(fd)
+
+    def post(self, tag):
+        """Fire tag from any thread."""
+        try:
+            self.loop.call_soon_threadsafe(self._fire, tag)
+        except RuntimeError:
+            # the loop has already shut down
+            pass
+
+    async def wait(self, timeout):
+        """Wait for events or the timeout.
+
+        Args:
+            timeout (float): Maximum time to wait in seconds
+
+        Returns:
+            list: Tags of the events that fired, in order (empty on timeout)
+        """
+        if not self.fired:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        self.wakeup.clear()
+        fired, self.fired = self.fired, []
+        return fired
+
+
+class Buttons:
+    """Edge triggered Pirate Audio buttons.
+
+    Each configured pin gets a falling edge interrupt (the buttons pull the
+    pin low). Presses are debounced by the GPIO driver and again in software,
+    queued, and the display loop is woken through notify(), so a press is
+    handled within one loop pass instead of waiting for a poll.
+
+    RPi.GPIO is used where it works; otherwise (Pi 5, or kernels without
+    the legacy sysfs interface) the edges are read from the GPIO character
+    device with libgpiod on a small watcher thread.
+
+    Args:
+        pins (dict): BCM pin number -> action ('play_pause', 'volume_up',
+                     'volume_down', 'next', 'previous')
+        bouncetime (int): Debounce time in milliseconds
+        notify (callable): Called from the GPIO thread after each press
+        gpio: RPi.GPIO compatible module (None picks RPi.GPIO or gpiod,
+              whichever works)
+
+    Raises:
+        ImportError: If neither RPi.GPIO nor gpiod is installed
+        RuntimeError: If the GPIO lines cannot be set up
+
+    Example:
+        >>> buttons = Buttons(BUTTON_PINS, 150, lambda: events.post('button'))
+        >>> for action in buttons.take():
+        ...     mpd_status = await press_button(mpd, mpd_status, action)
+    """
+
+    # gpiochip labels of the Raspberry Pi header GPIOs (line offset = BCM pin)
+    CHIP_LABELS = ('pinctrl-rp1', 'pinctrl-bcm2712', 'pinctrl-bcm2711', 'pinctrl-bcm2835')
+
+    def __init__(self, pins, bouncetime=BUTTON_BOUNCE, notify=None, gpio=None):
+        self.gpio = None
+        self.request = None
+        self.thread = None
+        self.stopping = threading.Event()
+        self.pins = dict(pins)
+        self.bounce = bouncetime / 1000.0
+        self.notify = notify
+        self.last = {}
+        self.presses = deque()
+        if gpio is not None:
+            self._setup_rpi(gpio, bouncetime)
+            return
+        try:
+            import RPi.GPIO as gpio
+            self._setup_rpi(gpio, bouncetime)
+        except (ImportError, RuntimeError) as e:
+            # RPi.GPIO is missing, or cannot drive this board (Pi 5)
+            try:
+                self._setup_gpiod(bouncetime)
+            except ImportError:
+                raise e from None
+
+    def _setup_rpi(self, gpio, bouncetime):
+        self.gpio = gpio
+        try:
+            gpio.setmode(gpio.BCM)
+            for pin in self.pins:
+                gpio.setup(pin, gpio.IN, pull_up_down=gpio.PUD_UP)
+                gpio.add_event_detect(pin, gpio.FALLING, callback=self._pressed, bouncetime=bouncetime)
+        except RuntimeError:
+            gpio.cleanup(list(self.pins))
+            self.gpio = None
+            raise
+
+    @classmethod
+    def _find_chip(cls, gpiod):
+        # the header GPIOs are not always gpiochip0 (e.g. gpiochip4 on early Pi 5 kernels)
+        chips = sorted(name for name in os.listdir('/dev') if name.startswith('gpiochip'))
+        for name in chips:
+            chip_path = '/dev/' + name
+            try:
+                with gpiod.Chip(chip_path) as chip:
+                    if chip.get_info().label in cls.CHIP_LABELS:
+                        return chip_path
+            except OSError:
+                continue
+        return '/dev/gpiochip0'
+
+    def _setup_gpiod(self, bouncetime):
+        import gpiod
+        from datetime import timedelta
+        from gpiod.line import Bias, Direction, Edge
+        settings = gpiod.LineSettings(direction=Direction.INPUT, edge_detection=Edge.FALLING,
+                                      bias=Bias.PULL_UP, debounce_period=timedelta(milliseconds=bouncetime))
+        try:
+            self.request = gpiod.request_lines(self._find_chip(gpiod), consumer='tft-moodecoverart',
+                                               config={tuple(self.pins): settings})
+        except OSError as e:
+            raise RuntimeError('cannot request GPIO lines: {}'.format(e)) from e
+        self.thread = threading.Thread(target=self._watch, name='buttons', daemon=True)
+        self.thread.start()
+
+    def _watch(self):
+        # gpiod watcher thread: wait for edges, checking for close() twice a second
+        while not self.stopping.is_set():
+            try:
+                if not self.request.wait_edge_events(0.5):
+                    continue
+                for event in self.request.read_edge_events():
+                    self._pressed(event.line_offset)
+            except OSError:
+                return
+
+    def _pressed(self, pin):
+        now = time.monotonic()
+        if now - self.last.get(pin, -self.bounce) < self.bounce:
+            return
+        self.last[pin] = now
+        self.presses.append(self.pins[pin])
+        if self.notify is not None:
+            self.notify()
+
+    def take(self):
+        """Return the actions pressed since the last call, oldest first."""
+        actions = []
+        while self.presses:
+            actions.append(self.presses.popleft())
+        return actions
+
+    def close(self):
+        if self.gpio is not None:
+            for pin in self.pins:
+                self.gpio.remove_event_detect(pin)
+            self.gpio.cleanup(list(self.pins))
+        if self.request is not None:
+            self.stopping.set()
+            self.thread.join()
+            self.request.release()
+
+
+async def press_button(mpd, mpd_status, action):
+    """Send a button's MPD command and predict the resulting status.
+
+    The returned status already shows the expected outcome (new volume,
+    toggled play state), so the overlay can be redrawn before MPD confirms;
+    MPD's own idle events reconcile it on the next status refresh.
+
+    Args:
+        mpd (MPDConnection): MPD connection
+        mpd_status (dict): Current MPD status
+        action (str): Button action (see Buttons)
+
+    Returns:
+        dict: Optimistic MPD status
+    """
+    status = dict(mpd_status)
+    if action == 'play_pause':
+        if status.get('state') == 'play':
+            await mpd.command('pause', 1)
+            status['state'] = 'pause'
+        else:
+            await mpd.command('play')
+            status['state'] = 'play'
+    elif (action == 'volume_up') or (action == 'volume_down'):
+        # -1 means MPD has no volume control
+        if int(status.get('volume', -1)) >= 0:
+            step = VOLUME_STEP if action == 'volume_up' else -VOLUME_STEP
+            vol = min(100, max(0, int(status['volume']) + step))
+            await mpd.command('setvol', vol)
+            status['volume'] = str(vol)
+    elif action == 'next':
+        await mpd.command('next')
+    elif action == 'previous':
+        await mpd.command('previous')
+    return status
+
+
+def parseMoodeMetadata(nowplayingmeta):
+    """Convert the lines of Moode's currentsong.txt into a metadata dictionary.
+
+    Extracts playback information including artist, album, title, cover URL
+    and audio source type. Handles special cases for radio streams,
+    Bluetooth, Airplay, Spotify and other input sources. The file itself is
+    read by MetadataWatcher.
+
+    Args:
+        nowplayingmeta (list): Lines of the metadata file without newlines
+
+    Returns:
+        dict: Dictionary containing metadata with keys:
+            - 'artist': Artist name
+            - 'album': Album name
+            - 'title': Track title
+            - 'file': File path or stream URL
+            - 'coverurl': URL/path to cover art
+            - 'source': Audio source type ('library', 'radio', 'bluetooth',
+                       'airplay', 'spotify', 'squeeze', 'input')
+
+    Raises:
+        ValueError: If a line is not a key=value pair
+        KeyError: If the mandatory 'coverurl' key is missing
+
+    Note:
+        For radio streams with combined artist/title (format "Artist - Title"),
+        the function automatically splits them into separate fields.
+    """
+    # Initalise dictionary
+    metaDict = {}
+    i = 0
+    while i < len(nowplayingmeta):
+        # traverse list converting to a dictionary
+        (key, value) = nowplayingmeta[i].split('=', 1)
+        metaDict[key] = value
+        i += 1
+    
+    metaDict['coverurl'] = urllib.parse.unquote(metaDict['coverurl'])
+    
+    metaDict['source'] = 'library'
+    if 'file' in metaDict:
+        if (metaDict['file'].find('http://', 0) > -1) or (metaDict['file'].find('https://', 0) > -1):
+            # set radio stream to true
+            metaDict['source'] = 'radio'
+            # if radio station has arist and title in one line separated by a hyphen, split into correct keys
+            if metaDict['title'].find(' - ', 0) > -1:
+                (art,tit) = metaDict['title'].split(' - ', 1)
+                metaDict['artist'] = art
+                metaDict['title'] = tit
+        elif metaDict['file'].find('Bluetooth Active', 0) > -1:
+            metaDict['source'] = 'bluetooth'
+        elif metaDict['file'].find('Airplay Active', 0) > -1:
+            metaDict['source'] = 'airplay'
+        elif metaDict['file'].find('Spotify Active', 0) > -1:
+            metaDict['source'] = 'spotify'
+        elif metaDict['file'].find('Squeezelite Active', 0) > -1:
+            metaDict['source'] = 'squeeze'
+        elif metaDict['file'].find('Input Active', 0) > -1:
+            metaDict['source'] = 'input' 
+
+    return metaDict
+
+
+class MetadataWatcher:
+    """Change-notified reader for Moode's currentsong.txt.
+
+    The file is only re-parsed when it has actually been rewritten. Changes are
+    detected with inotify on the containing directory when the kernel supports
+    it, otherwise by comparing the file's inode, size and mtime on each read.
+    Files on network filesystems (e.g. another Moode's currentsong.txt mounted
+    over NFS or SMB) are always polled, as inotify only reports local writes.
+    The last good parse is kept as an immutable mapping and returned until a
+    complete new version of the file is available, so a read that races with
+    Moode's truncate-then-write never yields a half-filled dictionary.
+
+    Args:
+        filename (str): Path to the metadata file
+                       (typically /var/local/www/currentsong.txt)
+
+    Example:
+        >>> watcher = MetadataWatcher('/var/local/www/currentsong.txt')
+        >>> meta = watcher.read()
+        >>> meta.get('title')
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.name = os.fsencode(os.path.basename(filename))
+        # until a complete file is read (e.g. not written or mounted yet)
+        self.metadata = MappingProxyType({'source': 'library'})
+        self.signature = None
+        self.pending = True
+        directory = os.path.dirname(filename) or '.'
+        self.fd = None if _remote_filesystem(directory) else _inotify_watch(directory, INOTIFY_MASK)
+
+    def fileno(self):
+        """Return the inotify descriptor for select(), or None when polling."""
+        return self.fd
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def _drain(self):
+        # consume queued inotify events, noting whether any concern our file
+        try:
+            buf = os.read(self.fd, 4096)
+        except BlockingIOError:
+            return
+        except OSError:
+            # watch is broken, fall back to stat polling
+            self.close()
+            self.pending = True
+            return
+        offset = 0
+        while offset + INOTIFY_EVENT.size <= len(buf):
+            _, mask, _, length = INOTIFY_EVENT.unpack_from(buf, offset)
+            offset += INOTIFY_EVENT.size
+            name = buf[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if name == self.name or (mask & INOTIFY_Q_OVERFLOW):
+                self.pending = True
+
+    def read(self):
+        """Return the current metadata, re-parsing only if the file changed.
+
+        Returns:
+            MappingProxyType: Read-only metadata mapping (see parseMoodeMetadata())
+        """
+        if self.fd is not None:
+            self._drain()
+            if not self.pending:
+                return self.metadata
+        try:
+            st = os.stat(self.filename)
+        except OSError:
+            return self.metadata
+        signature = (st.st_ino, st.st_size, st.st_mtime_ns)
+        if signature == self.signature:
+            self.pending = False
+            return self.metadata
+        try:
+            with open(self.filename) as metafile:
+                content = metafile.read()
+            st = os.stat(self.filename)
+            # an empty file, a missing final newline, or any change of inode,
+            # size or mtime during the read means Moode is still writing: keep
+            # the previous record and read again on the next pass
+            if (not content.endswith('\n')) or ((st.st_ino, st.st_size, st.st_mtime_ns) != signature) \
+                    or (st.st_size != len(content.encode())):
+                return self.metadata
+            metaDict = parseMoodeMetadata(content.rstrip('\n').split('\n'))
+        except (OSError, ValueError, KeyError, UnicodeDecodeError):
+            return self.metadata
+        self.signature = signature
+        self.metadata = MappingProxyType(metaDict)
+        self.pending = False
+        return self.metadata
+
+
+def getMoodeMetadata(filename):
+    """Read Moode Audio metadata from currentsong.txt once.
+
+    Convenience wrapper for one-off reads (tools, benchmarks); the display
+    loop keeps a MetadataWatcher instead, so the file is only parsed when it
+    changes.
+
+    Args:
+        filename (str): Path to the currentsong.txt metadata file
+                       (typically /var/local/www/currentsong.txt)
+
+    Returns:
+        dict: Metadata as described in parseMoodeMetadata(), or just
+              ``{'source': 'library'}`` if the file is missing or still being
+              written
+    """
+    watcher = MetadataWatcher(filename)
+    try:
+        return dict(watcher.read())
+    finally:
+        watcher.close()
+
+
+def _remote_filesystem(directory):
+    """Return True if a directory is on a network filesystem (see REMOTE_FILESYSTEMS).
+
+    The mount containing the directory is looked up in /proc/mounts; if that
+    cannot be read the directory is treated as local.
+    """
+    target = os.path.realpath(directory)
+    mount, fstype = '', ''
+    try:
+        with open('/proc/mounts') as mounts:
+            for line in mounts:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                point = fields[1].replace('\\040', ' ')
+                inside = (target == point) or target.startswith(point.rstrip('/') + '/')
+                if inside and (len(point) > len(mount)):
+                    mount, fstype = point, fields[2]
+    except OSError:
+        return False
+    return fstype in REMOTE_FILESYSTEMS
+
+
+def _inotify_watch(directory, mask):
+    """Create a non-blocking inotify descriptor watching a directory.
+
+    Args:
+        directory (str): Directory to watch
+        mask (int): inotify event mask
+
+    Returns:
+        int: File descriptor, or None if inotify is unavailable
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    if libc.inotify_add_watch(fd, os.fsencode(directory), mask) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+class CoverResolver:
+    """Find folder cover images with one directory scan per album.
+
+    Each album directory is listed once with os.scandir() and its entries are
+    matched case-insensitively against the configured names and extensions.
+    The result, including "no cover image here", is remembered together with
+    the directory mtime, so later tracks of the album only cost a single
+    stat() call, and adding or renaming an image invalidates the entry.
+
+    Args:
+        names (tuple): Base names in priority order (e.g. 'cover', 'folder')
+        extensions (tuple): File extensions in priority order
+        max_dirs (int): Number of directories remembered
+
+    Example:
+        >>> resolver = CoverResolver(('cover', 'folder'), ('jpg', 'png'))
+        >>> resolver.find('/var/lib/mpd/music/Album')
+        '/var/lib/mpd/music/Album/Folder.JPG'
+    """
+
+    def __init__(self, names=COVER_NAMES, extensions=COVER_EXTENSIONS, max_dirs=COVER_DIRS):
+        self.priority = [(name + '.' + ext).lower() for name in names for ext in extensions]
+        self.max_dirs = max_dirs
+        self.dirs = OrderedDict()
+        self.lock = threading.Lock()
+
+    def find(self, directory):
+        """Return the path of the directory's cover image, or None.
+
+        Args:
+            directory (str): Album directory
+
+        Returns:
+            str: Path of the best matching image, or None if there is none
+        """
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+        except OSError:
+            return None
+        with self.lock:
+            entry = self.dirs.get(directory)
+            if (entry is not None) and (entry[0] == mtime):
+                self.dirs.move_to_end(directory)
+                stats.count('cover_dir_hits')
+                return entry[1]
+        stats.count('cover_dir_scans')
+        found = {}
+        try:
+            with os.scandir(directory) as it:
+                for dirent in it:
+                    name = dirent.name.lower()
+                    if name in self.priority:
+                        found.setdefault(name, dirent.path)
+        except OSError:
+            return None
+        image = next((found[name] for name in self.priority if name in found), None)
+        with self.lock:
+            self.dirs[directory] = (mtime, image)
+            self.dirs.move_to_end(directory)
+            while len(self.dirs) > self.max_dirs:
+                self.dirs.popitem(last=False)
+        return image
+
+
+cover_resolver = CoverResolver()
+
+
+def open_cover(fp, size=None):
+    """Open and decode a cover image at no more than twice the display size.
+
+    JPEGs are decoded with DCT scaling (1/2 to 1/8 of the original size), so
+    a 4000x4000 embedded cover never exists at full resolution in memory.
+    Formats without reduced decoding (PNG, TIFF, ...) are decoded in full and
+    then shrunk, as long as they fit the decode pixel budget.
+
+    Args:
+        fp (str or file): Image path or file object
+        size (tuple): Frame size (defaults to the configured display)
+
+    Returns:
+        PIL.Image: Decoded image no larger than 2x the display size
+
+    Raises:
+        ValueError: If the image exceeds COVER_MAX_PIXELS after scaling
+        OSError: If the image cannot be read
+    """
+    cover = Image.open(fp)
+    # covers are cropped to the frame later, so its longer side counts
+    side = max(size or GEOMETRY.size)
+    target = (2 * side, 2 * side)
+    # largest DCT scale that still leaves at least the display size
+    # (no-op for formats other than JPEG)
+    cover.draft('RGB', (side, side))
+    if cover.width * cover.height > COVER_MAX_PIXELS:
+        raise ValueError('cover too large to decode: {}x{}'.format(cover.width, cover.height))
+    cover.thumbnail(target, Image.Resampling.LANCZOS)
+    return cover
+
+
+@stats.timed('cover_resolve')
+def get_cover(metaDict, size=None, music_dir=None):
+    """Retrieve cover art image based on metadata.
+    
+    Searches for and returns album artwork from multiple sources in order of priority:
+    1. Radio station logos (for radio streams)
+    2. Source-specific backgrounds (Bluetooth, Airplay, Spotify, etc.)
+    3. Embedded artwork in audio files
+    4. Folder images (Cover.jpg, Folder.jpg, etc.)
+    5. Default cover image as fallback
+    
+    Args:
+        metaDict (dict): Metadata dictionary from parseMoodeMetadata() containing
+                        'source', 'file', and 'coverurl' keys
+        size (tuple): Frame size (defaults to the configured display)
+        music_dir (str): Music directory of the player the track comes from
+                         (defaults to MUSIC_DIR)
+    
+    Returns:
+        PIL.Image: Cover art image, decoded at most at twice the display
+                   size (see open_cover()), resized to the display later
+    
+    Note:
+        For library files, checks for embedded art first, then looks up the
+        configured cover image names (case-insensitive) in the same directory
+        as the audio file using cover_resolver.
+    """
+    cover = None
+    cover = Image.open(script_path + '/images/default-cover-v6.jpg')
+    source = metaDict['source']
+    if metaDict['source'] == 'radio':
+        if 'coverurl' in metaDict:
+            rc = WWW_DIR + metaDict['coverurl']
+            if path.exists(rc):
+                if rc != WWW_DIR + 'images/default-cover-v6.svg':
+                    cover = open_cover(rc, size)
+
+    elif source in source_backgrounds:
+        cover = load_asset(source_backgrounds[source], size)
+    else:
+        if 'file' in metaDict:
+            if len(metaDict['file']) > 0:
+
+                # mediafile pulls in mutagen, so it is only imported when needed
+                from mediafile import MediaFile
+                fp = (music_dir or MUSIC_DIR) + metaDict['file']   
+                mf = MediaFile(fp)     
+                if mf.art:
+                    cover = open_cover(BytesIO(mf.art), size)
+                    return cover
+                else:
+                    cp = cover_resolver.find(os.path.dirname(fp))
+                    if cp is not None:
+                        cover = open_cover(cp, size)
+                        return cover
+    return cover
+
+
+# Display-ready cover: resized image, its blurred variant, mean luminance and
+# per band (luminance, contrast) from analyse_bands()
+PreparedCover = namedtuple('PreparedCover', ['image', 'blurred', 'mean', 'bands'])
+
+# Compiled layout elements. Text is drawn from a TextSprite of the metadata
+# field at left (or centred), scrolling when wider than the display; bars draw
+# their track and fill up to the value's fraction of the track width.
+TextOp = namedtuple('TextOp', ['kind', 'name', 'field', 'font', 'top', 'left', 'centre'])
+BarOp = namedtuple('BarOp', ['kind', 'name', 'value', 'track', 'span', 'box'])
+# ops in drawing order, rows per colour band, the time bar op (or None) and
+# the Geometry the ops were scaled to
+Layout = namedtuple('Layout', ['ops', 'bands', 'timebar', 'geometry'])
+
+# track colour behind the bar fill
+BAR_TRACK = (255,255,255,145)
+BAR_VALUES = ('volume', 'time')
+
+
+def compile_layout(spec, overlay=None, timebar=None, shade=None, geometry=None):
+    """Compile a layout spec into a flat plan of draw ops.
+
+    Each element of the spec is either a text line or a bar:
+
+    - ``text``: metadata field (artist, album, title or any other key of
+      currentsong.txt), ``top``, font ``size``, optional ``font`` file in
+      fonts/, ``align`` (center or left) and ``left`` (x of left aligned
+      text and where scrolling starts)
+    - ``bar``: volume or time, ``top``, ``height`` and ``left``/``right``
+      margins
+
+    Fonts are loaded, rows and rectangles resolved and elements hidden by
+    the overlay settings dropped once, so frames only walk the ops.
+    Coordinates, font sizes and bar heights are given for a 240x240 screen
+    and scaled to the display geometry (see Geometry). Each
+    element also names a colour band (its ``name``, by default the field or
+    value) whose rows are analysed per cover; the bands cover every element
+    whether shown or not, so cached cover analysis does not depend on the
+    overlay settings.
+
+    Args:
+        spec (list): Layout elements, see LAYOUT
+        overlay (int): Overlay setting (defaults to OVERLAY)
+        timebar (int): Time bar setting (defaults to TIMEBAR)
+        shade (int): Text shadow offset (defaults to SHADE)
+        geometry (Geometry): Display geometry (defaults to the configured display)
+
+    Returns:
+        Layout: Ops to draw, colour band rows, the time bar op and the geometry
+
+    Raises:
+        ValueError: On an element that is neither a text nor a known bar
+
+    Example:
+        >>> plan = compile_layout([{'text': 'title', 'top': 105, 'size': 30}], shade=0)
+        >>> plan.bands
+        {'title': (105, 141)}
+    """
+    overlay = OVERLAY if overlay is None else overlay
+    timebar = TIMEBAR if timebar is None else timebar
+    shade = SHADE if shade is None else shade
+    geometry = geometry or GEOMETRY
+    width = geometry.size[0]
+    ops = []
+    bands = {}
+    shown_timebar = None
+    for element in spec:
+        top = geometry.y(int(element.get('top', 0)))
+        if 'text' in element:
+            field = element['text']
+            name = element.get('name', field)
+            font = load_font(element.get('font', FONT), geometry.scaled(int(element.get('size', 24))))
+            bands[name] = (top, top + sum(font.getmetrics()) + shade)
+            if overlay < 3:
+                ops.append(TextOp('text', name, field, font, top, float(geometry.scaled(element.get('left', 20))),
+                                  element.get('align', 'center') != 'left'))
+        elif element.get('bar') in BAR_VALUES:
+            value = element['bar']
+            name = element.get('name', value)
+            height = geometry.scaled(int(element.get('height', 9)))
+            bands[name] = (top, top + height)
+            if (value == 'volume') and not (0 < overlay < 3):
+                continue
+            if (value == 'time') and not ((overlay < 3) and (timebar == 1)):
+                continue
+            left = geometry.scaled(int(element.get('left', 5)))
+            track = (left, top, width - geometry.scaled(int(element.get('right', 5))), top + height - 1)
+            op = BarOp('bar', name, value, track, track[2] - track[0], (0, top, width, top + height))
+            if (value == 'time') and (shown_timebar is None):
+                shown_timebar = op
+            ops.append(op)
+        else:
+            raise ValueError('unknown layout element: {!r}'.format(element))
+    return Layout(tuple(ops), bands, shown_timebar, geometry)
+
+
+@functools.lru_cache(maxsize=None)
+def colour_bands(size):
+    """Return the colour band rows of the layout at a frame size.
+
+    Colours are chosen per band so text stays readable on covers with bright
+    or busy parts; the rows behind each text line and bar only depend on the
+    layout and the frame size.
+
+    Args:
+        size (tuple): Frame size (width, height)
+
+    Returns:
+        dict: Band name -> (first row, end row)
+    """
+    return compile_layout(LAYOUT, geometry=Geometry(size[0], size[1], 0, 0, 0)).bands
+
+
+# Rows behind each text line and bar of the layout on the configured display
+COLOUR_BANDS = colour_bands(GEOMETRY.size)
+# luminance standard deviation above which a band counts as busy
+BUSY_CONTRAST = 50.0
+LUMA = np.array([0.299, 0.587, 0.114], dtype=np.float32)
+
+
+def luminance(image):
+    """Return the per-pixel luminance (0-255) of an RGB image as a float array."""
+    return np.asarray(image, dtype=np.float32) @ LUMA
+
+
+def analyse_bands(image):
+    """Measure luminance and contrast behind each text line and bar.
+
+    Args:
+        image (PIL.Image): Display-sized RGB layer the text is drawn on
+
+    Returns:
+        dict: Band name (see colour_bands()) -> (mean luminance, luminance
+              standard deviation)
+    """
+    lum = luminance(image)
+    return {band: (round(float(lum[y0:y1].mean()), 2), round(float(lum[y0:y1].std()), 2))
+            for band, (y0, y1) in colour_bands(image.size).items()}
+
+
+def prepare_cover(cover, size=None):
+    """Turn a cover image into display-ready layers.
+
+    Covers are scaled to cover the frame and centre cropped, so square art
+    keeps its aspect ratio on 320x240 and 240x320 panels.
+
+    Args:
+        cover (PIL.Image): Cover art as returned by get_cover()
+        size (tuple): Frame size (defaults to the configured display)
+
+    Returns:
+        PreparedCover: Resized RGB cover, blurred RGB cover, mean luminance
+                       and band analysis
+    """
+    with stats.time('cover_resize'):
+        resized = ImageOps.fit(cover, size or GEOMETRY.size, Image.Resampling.LANCZOS).convert('RGB')
+    with stats.time('blur'):
+        blurred = resized.filter(ImageFilter.GaussianBlur)
+    with stats.time('contrast'):
+        # text is drawn on the blurred layer (the sharp one has no overlays)
+        bands = analyse_bands(blurred)
+        cover_mean = float(luminance(resized).mean())
+    return PreparedCover(resized, blurred, cover_mean, bands)
+
+
+def cover_cache_key(metaDict, music_dir=None):
+    """Build the on-disk cache key for a track's cover art.
+
+    The key identifies the artwork source without opening it: the audio file
+    path with its size and mtime plus the album directory mtime (so adding or
+    replacing a folder image is noticed), or the radio logo path and mtime.
+
+    Args:
+        metaDict (dict): Metadata dictionary from parseMoodeMetadata()
+        music_dir (str): Music directory of the track (defaults to MUSIC_DIR)
+
+    Returns:
+        tuple: Key parts, or None if the cover should not be cached on disk
+    """
+    try:
+        if metaDict['source'] == 'radio':
+            rc = WWW_DIR + metaDict.get('coverurl', '')
+            st = os.stat(rc)
+            return ('radio', rc, st.st_mtime_ns, st.st_size)
+        if (metaDict['source'] == 'library') and metaDict.get('file'):
+            fp = (music_dir or MUSIC_DIR) + metaDict['file']
+            st = os.stat(fp)
+            dst = os.stat(os.path.dirname(fp))
+            return ('library', fp, st.st_mtime_ns, st.st_size, dst.st_mtime_ns)
+    except (OSError, KeyError):
+        pass
+    return None
+
+
+class CoverCache:
+    """Persistent cache of display-ready cover art.
+
+    Entries are content addressed by a hash of cover_cache_key(), the frame
+    size and the layout's colour bands. Each entry is stored as two PNG files (resized and blurred)
+    with the luminance and band analysis kept in text chunks. Hits refresh the file mtime,
+    which is used as the LRU order when the entry or size budget is exceeded.
+
+    Args:
+        directory (str): Cache directory (relative paths are below the script)
+        max_entries (int): Maximum number of cached covers (0 disables the cache)
+        max_mb (float): Maximum total size of the cache in megabytes
+
+    Example:
+        >>> cache = CoverCache('cache/covers', 1000, 64)
+        >>> prepared = cache.load(key) or prepare_cover(get_cover(meta))
+    """
+
+    def __init__(self, directory, max_entries=COVER_CACHE_ENTRIES, max_mb=COVER_CACHE_MB):
+        self.directory = os.path.join(script_path, directory)
+        self.max_entries = max_entries
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.enabled = max_entries > 0
+        if self.enabled:
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+            except OSError:
+                self.enabled = False
+
+    def _paths(self, key, size):
+        # the band analysis depends on the layout rows
+        digest = hashlib.sha1(repr((key, size, sorted(colour_bands(size).items()))).encode('utf-8', 'surrogateescape')).hexdigest()
+        base = os.path.join(self.directory, digest)
+        return base + '.png', base + '-blur.png'
+
+    def load(self, key, size=None):
+        """Return the cached PreparedCover for key and frame size, or None on a miss."""
+        if not self.enabled or key is None:
+            return None
+        image_path, blur_path = self._paths(key, size or GEOMETRY.size)
+        try:
+            image = Image.open(image_path)
+            image.load()
+            blurred = Image.open(blur_path)
+            blurred.load()
+            cover_mean = float(image.text['mean'])
+            bands = {band: tuple(value) for band, value in json.loads(image.text['bands']).items()}
+            os.utime(image_path)
+            os.utime(blur_path)
+        except (OSError, KeyError, ValueError, TypeError):
+            stats.count('cover_cache_misses')
+            return None
+        stats.count('cover_cache_hits')
+        return PreparedCover(image.convert('RGB'), blurred.convert('RGB'), cover_mean, bands)
+
+    def store(self, key, prepared):
+        """Write a PreparedCover to the cache and evict old entries if needed."""
+        if not self.enabled or key is None:
+            return
+        image_path, blur_path = self._paths(key, prepared.image.size)
+        info = PngImagePlugin.PngInfo()
+        info.add_text('mean', repr(prepared.mean))
+        info.add_text('bands', json.dumps(prepared.bands))
+        try:
+            # write to temporary names first so readers never see partial files
+            prepared.blurred.save(blur_path + '.tmp', 'PNG')
+            os.replace(blur_path + '.tmp', blur_path)
+            prepared.image.save(image_path + '.tmp', 'PNG', pnginfo=info)
+            os.replace(image_path + '.tmp', image_path)
+        except OSError:
+            return
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until the cache is within budget."""
+        entries = {}
+        try:
+            with os.scandir(self.directory) as it:
+                for entry in it:
+                    if not entry.name.endswith('.png'):
+                        continue
+                    st = entry.stat()
+                    digest = entry.name.split('.')[0].split('-')[0]
+                    used, size = entries.get(digest, (0, 0))
+                    entries[digest] = (max(used, st.st_mtime), size + st.st_size)
+        except OSError:
+            return
+        total = sum(size for _, size in entries.values())
+        count = len(entries)
+        for digest, (_, size) in sorted(entries.items(), key=lambda item: item[1][0]):
+            if count <= self.max_entries and total <= self.max_bytes:
+                break
+            for name in (digest + '.png', digest + '-blur.png'):
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+            count -= 1
+            total -= size
+
+
+def load_cover(metaDict, cache=None, size=None, music_dir=None):
+    """Return the display-ready cover for a track, using the disk cache.
+
+    Args:
+        metaDict (dict): Metadata dictionary from parseMoodeMetadata()
+        cache (CoverCache): Optional cover cache
+        size (tuple): Frame size (defaults to the configured display)
+        music_dir (str): Music directory of the track (defaults to MUSIC_DIR)
+
+    Returns:
+        PreparedCover: Display-ready cover layers
+    """
+    key = cover_cache_key(metaDict, music_dir) if cache is not None else None
+    if key is not None:
+        prepared = cache.load(key, size)
+        if prepared is not None:
+            return prepared
+    try:
+        cover = get_cover(metaDict, size, music_dir)
+    except Exception:
+        # missing, unreadable or unsupported file: show the default cover instead
+        cover = Image.open(script_path + '/images/default-cover-v6.jpg')
+    prepared = prepare_cover(cover, size)
+    if key is not None:
+        cache.store(key, prepared)
+    return prepared
+
+
+class Prefetcher:
+    """Prepare track artwork and text in the background.
+
+    Covers are resolved on a small worker pool: the cover is prepared (and
+    written to the disk cache) and the text sprites are rendered, so the
+    display loop only picks up finished results and never stalls on a slow
+    decode. When MPD reports a ``nextsong`` the next queued track is prepared
+    ahead of time, so the switch to it is instant. Pending work is cancelled
+    when the queue changes and results that are no longer wanted are discarded.
+    Finished results stay available until newer requests push them out, so
+    screens showing the same track share one decode. Work is keyed by the
+    cover and the requesting screen's frame size.
+
+    Args:
+        cache (CoverCache): Cover cache shared with the display loop
+        workers (int): Maximum number of concurrent prefetches
+        shade (int): Shadow offset for the text sprites
+        notify (callable): Called from the worker thread when a track is ready
+        pending (int): Requests and results kept, two per screen
+
+    Example:
+        >>> prefetcher = Prefetcher(cover_cache)
+        >>> prefetcher.request({'source': 'library', 'file': 'Album/02.flac'}, layout)
+        >>> ready = prefetcher.poll(meta, cover_cache_key(meta), layout)
+    """
+
+    def __init__(self, cache, workers=1, shade=0, notify=None, pending=2):
+        self.cache = cache
+        self.shade = shade
+        self.notify = notify
+        self.pending = pending
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='prefetch')
+        self.lock = threading.Lock()
+        self.futures = {}
+
+    def _prepare(self, metaDict, layout, music_dir):
+        if layout is None:
+            with stats.time('cover'):
+                return load_cover(metaDict, self.cache, music_dir=music_dir), {}
+        with stats.time('cover'):
+            prepared = load_cover(metaDict, self.cache, layout.geometry.size, music_dir)
+        return prepared, track_sprites(metaDict, cover_palette(prepared.mean, prepared.bands), self.shade, layout)
+
+    @staticmethod
+    def _key(key, layout):
+        return (key, None if layout is None else layout.geometry.size)
+
+    def request(self, metaDict, layout=None, music_dir=None):
+        """Queue a prefetch for a track unless one is already pending.
+
+        Args:
+            metaDict (dict): Metadata of the queued track (see parseMoodeMetadata())
+            layout (Layout): Compiled layout of the requesting screen; without
+                             one the cover is prepared at the configured size
+                             and no text is rendered
+            music_dir (str): Music directory of the requesting screen's
+                             player (defaults to MUSIC_DIR)
+        """
+        key = cover_cache_key(metaDict, music_dir)
+        if key is None:
+            return
+        key = self._key(key, layout)
+        with self.lock:
+            if key in self.futures:
+                return
+            # only the most recent requests are worth keeping
+            while len(self.futures) >= self.pending:
+                stale = next(iter(self.futures))
+                self.futures.pop(stale).cancel()
+            future = self.executor.submit(self._prepare, metaDict, layout, music_dir)
+            if self.notify is not None:
+                future.add_done_callback(lambda _: self.notify())
+            self.futures[key] = future
+
+    def cancel(self, keys=None, layout=None):
+        """Drop pending prefetches, e.g. after the queue was edited.
+
+        Args:
+            keys (iterable): Cover keys to drop, all of them when None
+            layout (Layout): Layout the keys were requested with
+        """
+        with self.lock:
+            if keys is None:
+                keys = list(self.futures)
+            else:
+                keys = [self._key(key, layout) for key in keys]
+            for key in keys:
+                future = self.futures.pop(key, None)
+                if future is not None:
+                    future.cancel()
+
+    def poll(self, metaDict, key, layout=None, music_dir=None):
+        """Collect a prepared track without blocking.
+
+        Args:
+            metaDict (dict): Track metadata, used to queue the work again if
+                             it was dropped in the meantime
+            key (tuple): Cover key from cover_cache_key()
+            layout (Layout): Compiled layout of the polling screen
+            music_dir (str): Music directory used when queueing it again
+
+        Returns:
+            tuple: (PreparedCover, sprites dict), or None while still preparing;
+                   the default cover if preparing it failed
+        """
+        key = self._key(key, layout)
+        with self.lock:
+            future = self.futures.get(key)
+            if (future is None) or future.cancelled():
+                self.futures.pop(key, None)
+                future = None
+            elif not future.done():
+                return None
+        if future is None:
+            self.request(metaDict, layout, music_dir)
+            return None
+        try:
+            return future.result()
+        except Exception as e:
+            # a failed worker must not end the screen: show the default cover,
+            # and forget the result so the track is tried again next time
+            print("cover preparation failed: {!r}".format(e))
+            with self.lock:
+                if self.futures.get(key) is future:
+                    del self.futures[key]
+            size = None if layout is None else layout.geometry.size
+            return prepare_cover(Image.open(script_path + '/images/default-cover-v6.jpg'), size), {}
+
+    def shutdown(self):
+        self.cancel()
+        self.executor.shutdown(wait=False)
+
+
+async def queued_track(mpd, mpd_status):
+    """Look up the metadata of the next track in MPD's queue.
+
+    Args:
+        mpd (MPDConnection): MPD connection
+        mpd_status (dict): Current MPD status
+
+    Returns:
+        dict: Metadata in parseMoodeMetadata() form, or None if there is no
+              next track or it is not a library file
+    """
+    if 'nextsongid' not in mpd_status:
+        return None
+    songs = await mpd.command('playlistid', mpd_status['nextsongid'])
+    if not songs:
+        return None
+    song = songs[0]
+    if song.get('file', '').find('://') > -1:
+        return None
+    metaDict = {'source': 'library', 'file': song['file']}
+    for field in ('artist', 'album', 'title'):
+        if field in song:
+            value = song[field]
+            metaDict[field] = value[0] if isinstance(value, list) else value
+    return metaDict
+
+
+def text_colours(mn):
+    """Choose text, shadow and bar colours for a cover's mean luminance.
+
+    Args:
+        mn (float): Mean luminance of the cover (0-255)
+
+    Returns:
+        tuple: (txt_col, str_col, bar_col, dark) where dark selects the dark
+               icon variants for bright covers
+    """
+    #txt_col = (255-int(im_mean[0]), 255-int(im_mean[1]), 255-int(im_mean[2]))
+    txt_col = (255,255,255)
+    str_col = (15,15,15)
+    bar_col = (255, 255, 255, 255)
+    dark = False
+    if mn > 175:
+        txt_col = (55,55,55)
+        str_col = (200,200,200)
+        dark=True
+        bar_col = (100,100,100,225)
+    if mn < 80:
+        txt_col = (200,200,200)
+        str_col = (55,55,55)
+    return txt_col, str_col, bar_col, dark
+
+
+def band_colours(lum, contrast):
+    """Choose text, shadow and bar colours for one band of a cover.
+
+    Starts from the text_colours() choice for the band's luminance; on busy
+    bands (high contrast) text and shadow are pushed to the extremes so the
+    outline stays visible over both light and dark parts.
+
+    Args:
+        lum (float): Mean luminance of the band (0-255)
+        contrast (float): Luminance standard deviation of the band
+
+    Returns:
+        tuple: (txt_col, str_col, bar_col)
+    """
+    txt_col, str_col, bar_col, _ = text_colours(lum)
+    if contrast > BUSY_CONTRAST:
+        if lum > 127:
+            txt_col, str_col = (20,20,20), (235,235,235)
+        else:
+            txt_col, str_col = (255,255,255), (0,0,0)
+    return txt_col, str_col, bar_col
+
+
+def cover_palette(cover_mean, bands=None):
+    """Choose colours for every text line and bar of a cover.
+
+    Args:
+        cover_mean (float): Mean luminance of the whole cover
+        bands (dict): Band analysis from analyse_bands(), or None to use the
+                      whole-cover luminance everywhere
+
+    Returns:
+        dict: Band name (see COLOUR_BANDS) -> (txt_col, str_col, bar_col)
+    """
+    if not bands:
+        colours = text_colours(cover_mean)[:3]
+        return {band: colours for band in COLOUR_BANDS}
+    return {band: band_colours(*bands[band]) for band in COLOUR_BANDS}
+
+
+def overlay_icon(mpd_status, dark):
+    """Select the control icon overlay for the current playback state.
+
+    Args:
+        mpd_status (dict): MPD status dictionary
+        dark (bool): True if the dark icon variants should be used
+
+    Returns:
+        str: Icon name (key of overlay_icons), or None if no icon is shown
+    """
+    if (OVERLAY == 0) or (OVERLAY == 3):
+        return None
+    if 'state' not in mpd_status:
+        return 'play'
+    if OVERLAY == 2:
+        icon = 'pause' if mpd_status['state'] != 'play' else 'play'
+    else:
+        icon = 'vol'
+    if dark is True:
+        icon += '_dark'
+    return icon
+
+
+def bar_fill(bar, mpd_status):
+    """Return the right edge of a bar's fill, or None if the value is unknown.
+
+    Args:
+        bar (BarOp): Volume or time bar from compile_layout()
+        mpd_status (dict): MPD status dictionary
+
+    Returns:
+        int: x of the fill's right edge (the track's left edge when empty)
+    """
+    if bar.value == 'volume':
+        if 'volume' not in mpd_status:
+            return None
+        fraction = min(max(int(mpd_status['volume']), 0), 100) / 100
+    else:
+        if ('elapsed' not in mpd_status) or ('duration' not in mpd_status):
+            return None
+        el_time = float(mpd_status['elapsed'])
+        du_time = float(mpd_status['duration'])
+        if du_time <= 0:
+            # streams report no (or a zero) duration
+            return None
+        fraction = min(max(el_time, 0.0), du_time) / du_time
+    return bar.track[0] + int(fraction * bar.span)
+
+
+class PlaybackClock:
+    """Interpolate the play position between MPD status updates.
+
+    MPD only reports ``elapsed`` when asked, so instead of a status round
+    trip for every time bar pixel the clock captures elapsed, duration and
+    play state with a monotonic timestamp whenever the status is refreshed
+    (on MPD player events such as seek, pause or track change, and on a
+    periodic resync) and advances the position locally in between.
+
+    Example:
+        >>> clock = PlaybackClock()
+        >>> clock.update(await mpd.status(), time.monotonic())
+        >>> status = clock.status(mpd_status, time.monotonic())
+    """
+
+    def __init__(self):
+        self.elapsed = 0.0
+        self.duration = 0.0
+        self.playing = False
+        self.stamp = 0.0
+
+    def update(self, mpd_status, now):
+        """Capture a fresh MPD status taken at monotonic time now."""
+        self.elapsed = float(mpd_status.get('elapsed', 0.0))
+        self.duration = float(mpd_status.get('duration', 0.0))
+        self.playing = mpd_status.get('state') == 'play'
+        self.stamp = now
+
+    def position(self, now):
+        """Return the interpolated elapsed time in seconds."""
+        if not self.playing:
+            return self.elapsed
+        position = self.elapsed + (now - self.stamp)
+        if self.duration > 0:
+            position = min(position, self.duration)
+        return position
+
+    def status(self, mpd_status, now):
+        """Return mpd_status with elapsed replaced by the interpolated position."""
+        if 'elapsed' not in mpd_status:
+            return mpd_status
+        status = dict(mpd_status)
+        status['elapsed'] = '{:.3f}'.format(self.position(now))
+        return status
+
+    def next_change(self, now, pixels):
+        """Return the monotonic time the time bar moves by its next pixel.
+
+        Args:
+            now (float): Current monotonic time
+            pixels (int): Width of the time bar in pixels
+
+        Returns:
+            float: Time of the next pixel step, or None if the bar is static
+                   (paused, stopped or a stream without duration)
+        """
+        if (not self.playing) or (self.duration <= 0):
+            return None
+        position = self.position(now)
+        if position >= self.duration:
+            return None
+        step = self.duration / pixels
+        following = (int(position / step) + 1) * step
+        return now + (following - position)
+
+
+def render_fingerprint(moode_meta, mpd_status, layout):
+    """Summarise the inputs that affect the pixels of the next frame.
+
+    Only state that is visible under the current overlay settings is
+    included, and bars are reduced to their pixel positions: with the time
+    bar hidden (or OVERLAY 3) the elapsed time is ignored, and volume only
+    matters while the volume bar is shown. Two equal fingerprints mean the
+    frame would be identical, so the redraw can be skipped.
+
+    Args:
+        moode_meta (dict): Metadata from parseMoodeMetadata()
+        mpd_status (dict): MPD status dictionary
+        layout (Layout): Compiled layout, only its shown elements count
+
+    Returns:
+        tuple: Hashable fingerprint of the visible state
+    """
+    source = moode_meta.get('source', '')
+    cover = (source, moode_meta.get('coverurl', ''), moode_meta.get('file', ''))
+    if (source != 'library') and (source != 'radio'):
+        # only the background and the file name are drawn
+        return cover
+    if OVERLAY == 3:
+        return cover
+    icon = ('state' in mpd_status) and (OVERLAY == 2) and (mpd_status['state'] != 'play')
+    shown = tuple(moode_meta.get(op.field) if op.kind == 'text' else bar_fill(op, mpd_status)
+                  for op in layout.ops)
+    return cover + ('state' in mpd_status, icon, shown)
+
+
+def compose_background(background, icon):
+    """Build the static background layer for a cover and control icon.
+
+    Args:
+        background (PIL.Image): Display-sized RGB cover (blurred if overlays are on)
+        icon (str): Icon name from overlay_icon(), or None
+
+    Returns:
+        PIL.Image: RGB image ready to be pasted into the frame
+    """
+    if icon is None:
+        return background
+    overlay = load_asset(overlay_icons[icon], background.size)
+    layer = background.copy()
+    layer.paste(overlay, (0,0), overlay)
+    return layer
+
+
+class LayerCache:
+    """Small LRU cache of precomposed background layers.
+
+    Layers only depend on the track, the play state and the overlay settings,
+    so they are built once per change and then just pasted on every frame.
+    A handful of entries is enough to flip between play and pause without
+    rebuilding.
+
+    Args:
+        size (int): Maximum number of layers to keep
+        name (str): Name used for the hit/miss counters in stats
+    """
+
+    def __init__(self, size=4, name='layer'):
+        self.size = size
+        self.name = name
+        self.layers = OrderedDict()
+
+    def get(self, key, build):
+        """Return the layer for key, calling build() to create it on a miss."""
+        layer = self.layers.get(key)
+        if layer is None:
+            stats.count(self.name + '_cache_misses')
+            layer = build()
+            self.layers[key] = layer
+            if len(self.layers) > self.size:
+                self.layers.popitem(last=False)
+        else:
+            stats.count(self.name + '_cache_hits')
+            self.layers.move_to_end(key)
+        return layer
 
+    def put(self, key, layer):
+        """Insert a layer that was built elsewhere (e.g. by a prefetch)."""
+        self.layers[key] = layer
+        self.layers.move_to_end(key)
+        if len(self.layers) > self.size:
+            self.layers.popitem(last=False)
 
 
-     
-# Standard SPI connections for ST7789
-# Create ST7789 LCD display class.
-if MODE == 3:    
-    disp = st7789.ST7789(
-        port=0,
-        cs=st7789.BG_SPI_CS_FRONT,  # GPIO 8, Physical pin 24
-        dc=9,
-        rst=22,
-        backlight=13,
-        rotation=ROTATION,
-        spi_speed_hz=SPI_SPEED
-    )   
-else:   
-    disp = st7789.ST7789(
-        port=0,
-        cs=st7789.BG_SPI_CS_FRONT,  # GPIO 8, Physical pin 24 
-        dc=9,
-        backlight=13,
-        rotation=ROTATION,
-        spi_speed_hz=SPI_SPEED
-    )
+class TextSprite:
+    """Pre-rendered text strip for one metadata field.
 
+    The text and its shadow are rasterised once into an RGBA strip. Text that
+    is wider than the display is rendered twice with a gap between the copies,
+    so any scroll position is just a crop of the strip. Frames then only paste
+    a window of the strip instead of asking FreeType to draw the glyphs again.
 
+    Args:
+        text (str): Text to render
+        font (ImageFont.FreeTypeFont): Font to render with
+        fill (tuple): Text colour
+        shadow_fill (tuple): Shadow colour
+        shade (int): Shadow offset in pixels (0 for no shadow)
+        gap (int): Gap in pixels between repeated copies of scrolling text
+        frame_width (int): Width of the frames the text is pasted into
+    """
 
-# Initialize display.
-disp.begin()
+    def __init__(self, text, font, fill, shadow_fill, shade=0, gap=60, frame_width=None):
+        bbox = font.getbbox(text)
+        self.width = bbox[2] - bbox[0]
+        self.frame_width = frame_width or GEOMETRY.size[0]
+        self.scrolls = self.width > self.frame_width
+        self.gap = gap
+        copies = [0, self.width + gap] if self.scrolls else [0]
+        size = (max(copies[-1] + bbox[2] + shade, 1), max(bbox[3] + shade, 1))
+        # glyph coverage is rendered as alpha masks over solid colour layers, so
+        # compositing the strip gives the same anti-aliasing as drawing directly
+        self.image = self._layer(text, font, fill, size, copies, 0)
+        if shade != 0:
+            shadow = self._layer(text, font, shadow_fill, size, copies, shade)
+            self.image = Image.alpha_composite(shadow, self.image)
 
+    @staticmethod
+    def _layer(text, font, fill, size, copies, offset):
+        mask = Image.new('L', size, 0)
+        draw = ImageDraw.Draw(mask)
+        for cx in copies:
+            draw.text((cx+offset, offset), text, font=font, fill=255)
+        layer = Image.new('RGBA', size, tuple(fill[:3]) + (255,))
+        layer.putalpha(mask)
+        return layer
 
-WIDTH = 240
-HEIGHT = 240
-font_s = ImageFont.truetype(script_path + '/fonts/Roboto-Medium.ttf',20)
-font_m = ImageFont.truetype(script_path + '/fonts/Roboto-Medium.ttf',24)
-font_l = ImageFont.truetype(script_path + '/fonts/Roboto-Medium.ttf',30)
+    def scroll(self, x, steps=1.0):
+        """Advance a scroll position.
 
+        Args:
+            x (float): Current x position of the first copy
+            steps (float): Time since the last frame in 50 ms units, so the
+                           scroll speed does not depend on the frame rate
 
-img = Image.new('RGB', (240, 240), color=(0, 0, 0, 25))
+        Returns:
+            float: New x position, wrapped once a full copy and gap has passed
+        """
+        x = x - (SCROLLSPEED * 0.5 * steps)
+        if x < -(self.width + self.gap):
+            x = 0
+        return x
 
-if PPBUTTON == 1:
-    # reversed play and pause icons
-    pause_icons = Image.open(script_path + '/images/controls-play.png').resize((240,240), resample=Image.Resampling.LANCZOS).convert("RGBA")
-    pause_icons_dark = Image.open(script_path + '/images/controls-play-dark.png').resize((240,240), resample=Image.Resampling.LANCZOS).convert("RGBA")
-    play_icons = Image.open(script_path + '/images/controls-pause.png').resize((240,240), resample=Image.Resampling.LANCZOS).convert("RGBA")
-    play_icons_dark = Image.open(script_path + '/images/controls-pause-dark.png').resize((240,240), resample=Image.Resampling.LANCZOS).convert("RGBA")
-else:
-    # original play and pause icons
-    play_icons = Image.open(script_path + '/images/controls-play.png').resize((240,240), resample=Image.Resampling.LANCZOS).convert("RGBA")
-    play_icons_dark = Image.open(script_path + '/images/controls-play-dark.png').resize((240,240), resample=Image.Resampling.LANCZOS).convert("RGBA")
-    pause_icons = Image.open(script_path + '/images/controls-pause.png').resize((240,240), resample=Image.Resampling.LANCZOS).convert("RGBA")
-    pause_icons_dark = Image.open(script_path + '/images/controls-pause-dark.png').resize((240,240), resample=Image.Resampling.LANCZOS).convert("RGBA")
+    def paste(self, img, x, top):
+        """Composite the visible window of the strip onto a frame.
 
-vol_icons = Image.open(script_path + '/images/controls-vol.png').resize((240,240), resample=Image.Resampling.LANCZOS).convert("RGBA")
-vol_icons_dark = Image.open(script_path + '/images/controls-vol-dark.png').resize((240,240), resample=Image.Resampling.LANCZOS).convert("RGBA")
+        Args:
+            img (PIL.Image): Frame to draw on
+            x (float): x position of the first copy of the text
+            top (int): y position of the text
 
-bt_back = Image.open(script_path + '/images/bta.png').resize((240,240), resample=Image.Resampling.LANCZOS).convert("RGBA")
-ap_back = Image.open(script_path + '/images/airplay.png').resize((240,240), resample=Image.Resampling.LANCZOS).convert("RGBA")
-jp_back = Image.open(script_path + '/images/jack.png').resize((240,240), resample=Image.Resampling.LANCZOS).convert("RGBA")
-sp_back = Image.open(script_path + '/images/spotify.png').resize((240,240), resample=Image.Resampling.LANCZOS).convert("RGBA")
-sq_back = Image.open(script_path + '/images/squeeze.png').resize((240,240), resample=Image.Resampling.LANCZOS).convert("RGBA")
+        Returns:
+            tuple: Frame area (x0, y0, x1, y1) that was drawn on
+        """
+        x = int(x)
+        if x >= 0:
+            window = self.image.crop((0, 0, self.frame_width - x, self.image.height))
+            img.paste(window, (x, top), window)
+        else:
+            window = self.image.crop((-x, 0, self.frame_width - x, self.image.height))
+            img.paste(window, (0, top), window)
+            x = 0
+        return (x, top, x + window.width, top + window.height)
 
 
-def isServiceActive(service):
-    """Check if a systemd service is active.
-    
-    Polls systemctl up to 30 times with 1 second intervals to determine if the
-    specified service is active. This provides a startup delay for services that
-    need time to initialize.
-    
+def text_sprite(sprites, text, font, fill, shadow_fill, shade, frame_width=None):
+    """Return a cached TextSprite, rendering it on first use.
+
     Args:
-        service (str): Name of the systemd service to check (e.g., 'mpd')
-    
+        sprites (LayerCache): Sprite cache
+        text (str): Text to render
+        font (ImageFont.FreeTypeFont): Font to render with
+        fill (tuple): Text colour
+        shadow_fill (tuple): Shadow colour
+        shade (int): Shadow offset in pixels
+        frame_width (int): Width of the frames (defaults to the configured display)
+
     Returns:
-        bool: True if service is active, False if not active after 30 attempts
-    
-    Example:
-        >>> if isServiceActive('mpd'):
-        ...     print("MPD is running")
+        TextSprite: Sprite for the given text and style
     """
-    waiting = True
-    count = 0
-    active = False
+    frame_width = frame_width or GEOMETRY.size[0]
+    key = (text, font, fill, shadow_fill, shade, frame_width)
+    return sprites.get(key, lambda: TextSprite(text, font, fill, shadow_fill, shade, frame_width=frame_width))
+
 
-    while (waiting == True):
+@stats.timed('text')
+def track_sprites(metaDict, palette, shade, layout):
+    """Render the text sprites a track will need before it starts playing.
 
-        process = subprocess.run(['systemctl','is-active',service], check=False, stdout=subprocess.PIPE, universal_newlines=True)
-        output = process.stdout
-        stat = output[:6]
+    Args:
+        metaDict (dict): Track metadata with optional artist, album and title
+        palette (dict): Colours per band from cover_palette()
+        shade (int): Shadow offset in pixels
+        layout (Layout): Compiled layout with the text lines to render
 
-        if stat == 'active':
-            waiting = False
-            active = True
+    Returns:
+        dict: Sprite cache keys (as used by text_sprite()) mapped to TextSprites
+    """
+    rendered = {}
+    frame_width = layout.geometry.size[0]
+    for op in layout.ops:
+        if (op.kind == 'text') and (op.field in metaDict):
+            txt_col, str_col, _ = palette[op.name]
+            key = (str(metaDict[op.field]), op.font, txt_col, str_col, shade, frame_width)
+            rendered[key] = TextSprite(str(metaDict[op.field]), op.font, txt_col, str_col, shade, frame_width=frame_width)
+    return rendered
 
-        if count > 29:
-            waiting = False
 
-        count += 1
-        time.sleep(1)
+def image_to_rgb565(image, rotation=0):
+    """Convert a frame to the panel's native RGB565 layout.
 
-    return active
+    Args:
+        image (PIL.Image): Frame in display coordinates
+        rotation (int): Display rotation in degrees (0, 90, 180, 270)
 
+    Returns:
+        numpy.ndarray: uint16 array in panel row/column order
+    """
+    pb = np.rot90(np.asarray(image.convert('RGB')), rotation // 90).astype('uint16')
+    return ((pb[:, :, 0] & 0xF8) << 8) | ((pb[:, :, 1] & 0xFC) << 3) | (pb[:, :, 2] >> 3)
+
+
+def panel_slice(box, rotation, size):
+    """Map a frame rectangle to the matching slice of the panel buffer.
 
-def getMoodeMetadata(filename):
-    """Parse Moode Audio metadata from currentsong.txt file.
-    
-    Reads the Moode Audio metadata file and extracts playback information including
-    artist, album, title, cover URL, and audio source type. Handles special cases
-    for radio streams, Bluetooth, Airplay, Spotify, and other input sources.
-    
     Args:
-        filename (str): Path to the currentsong.txt metadata file
-                       (typically /var/local/www/currentsong.txt)
-    
+        box (tuple): Frame rectangle (x0, y0, x1, y1), x1/y1 exclusive
+        rotation (int): Display rotation in degrees (0, 90, 180, 270)
+        size (tuple): Frame size (width, height)
+
     Returns:
-        dict: Dictionary containing metadata with keys:
-            - 'artist': Artist name
-            - 'album': Album name
-            - 'title': Track title
-            - 'file': File path or stream URL
-            - 'coverurl': URL/path to cover art
-            - 'source': Audio source type ('library', 'radio', 'bluetooth',
-                       'airplay', 'spotify', 'squeeze', 'input')
-    
-    Note:
-        For radio streams with combined artist/title (format "Artist - Title"),
-        the function automatically splits them into separate fields.
+        tuple: (rows, cols) slices into the panel-oriented buffer
     """
-    # Initalise dictionary
-    metaDict = {}
-    
-    if path.exists(filename):
-        # add each line fo a list removing newline
-        nowplayingmeta = [line.rstrip('\n') for line in open(filename)]
-        i = 0
-        while i < len(nowplayingmeta):
-            # traverse list converting to a dictionary
-            (key, value) = nowplayingmeta[i].split('=', 1)
-            metaDict[key] = value
-            i += 1
-        
-        metaDict['coverurl'] = urllib.parse.unquote(metaDict['coverurl'])
-        
-        metaDict['source'] = 'library'
-        if 'file' in metaDict:
-            if (metaDict['file'].find('http://', 0) > -1) or (metaDict['file'].find('https://', 0) > -1):
-                # set radio stream to true
-                metaDict['source'] = 'radio'
-                # if radio station has arist and title in one line separated by a hyphen, split into correct keys
-                if metaDict['title'].find(' - ', 0) > -1:
-                    (art,tit) = metaDict['title'].split(' - ', 1)
-                    metaDict['artist'] = art
-                    metaDict['title'] = tit
-            elif metaDict['file'].find('Bluetooth Active', 0) > -1:
-                metaDict['source'] = 'bluetooth'
-            elif metaDict['file'].find('Airplay Active', 0) > -1:
-                metaDict['source'] = 'airplay'
-            elif metaDict['file'].find('Spotify Active', 0) > -1:
-                metaDict['source'] = 'spotify'
-            elif metaDict['file'].find('Squeezelite Active', 0) > -1:
-                metaDict['source'] = 'squeeze'
-            elif metaDict['file'].find('Input Active', 0) > -1:
-                metaDict['source'] = 'input' 
-            
+    x0, y0, x1, y1 = box
+    w, h = size
+    k = (rotation // 90) % 4
+    if k == 0:
+        return slice(y0, y1), slice(x0, x1)
+    if k == 1:
+        return slice(w - x1, w - x0), slice(y0, y1)
+    if k == 2:
+        return slice(h - y1, h - y0), slice(w - x1, w - x0)
+    return slice(x0, x1), slice(h - y1, h - y0)
 
-    # return metadata
-    return metaDict
 
-def get_cover(metaDict):
-    """Retrieve cover art image based on metadata.
-    
-    Searches for and returns album artwork from multiple sources in order of priority:
-    1. Radio station logos (for radio streams)
-    2. Source-specific backgrounds (Bluetooth, Airplay, Spotify, etc.)
-    3. Embedded artwork in audio files
-    4. Folder images (Cover.jpg, Folder.jpg, etc.)
-    5. Default cover image as fallback
-    
+class RGB565Framebuffer:
+    """RGB565 conversion into persistent, preallocated panel buffers.
+
+    Frames are converted with in-place NumPy operations into two big-endian
+    uint16 buffers that are reused for the life of the display (current and
+    previous frame), so no per-frame arrays or byte strings are allocated.
+    Static background layers are converted once and cached; a frame built on
+    such a layer is produced by copying the converted layer and converting
+    only the rectangles that were drawn on top of it.
+
     Args:
-        metaDict (dict): Metadata dictionary from getMoodeMetadata() containing
-                        'source', 'file', and 'coverurl' keys
-    
+        size (tuple): Frame size (width, height)
+        rotation (int): Display rotation in degrees (0, 90, 180, 270)
+
+    Example:
+        >>> fb = RGB565Framebuffer(GEOMETRY.size, ROTATION)
+        >>> frame = fb.convert(img, ('cover', background, [(0, 7, 240, 40)]))
+    """
+
+    def __init__(self, size, rotation=0):
+        self.size = size
+        self.rotation = rotation
+        w, h = size
+        shape = (h, w) if (rotation // 90) % 2 == 0 else (w, h)
+        self.current = np.zeros(shape, dtype='>u2')
+        self.previous = np.zeros(shape, dtype='>u2')
+        self.tmp = np.empty(shape, dtype=np.uint16)
+        self.tmp2 = np.empty(shape, dtype=np.uint16)
+        self.layers = LayerCache(size=LAYER_CACHE_SIZE, name='rgb565')
+
+    def _pack(self, image, out):
+        # out[...] = RGB565 of the (rotated) image, using scratch buffers only
+        rgb = np.rot90(np.asarray(image), self.rotation // 90)
+        rows, cols = out.shape
+        tmp = self.tmp[:rows, :cols]
+        tmp2 = self.tmp2[:rows, :cols]
+        np.bitwise_and(rgb[:, :, 0], 0xF8, out=tmp, casting='unsafe')
+        np.left_shift(tmp, 8, out=tmp)
+        np.bitwise_and(rgb[:, :, 1], 0xFC, out=tmp2, casting='unsafe')
+        np.left_shift(tmp2, 3, out=tmp2)
+        np.bitwise_or(tmp, tmp2, out=tmp)
+        np.right_shift(rgb[:, :, 2], 3, out=tmp2, casting='unsafe')
+        np.bitwise_or(tmp, tmp2, out=out)
+
+    def _layer(self, image):
+        converted = np.empty(self.current.shape, dtype='>u2')
+        self._pack(image.convert('RGB'), converted)
+        return converted
+
+    def convert(self, image, layer=None):
+        """Convert a frame into the current buffer.
+
+        Args:
+            image (PIL.Image): RGB frame in display coordinates
+            layer (tuple): Optional (key, background, boxes) describing a frame
+                           that is the cached background with only the given
+                           rectangles drawn on top; otherwise the whole frame
+                           is converted
+
+        Returns:
+            numpy.ndarray: The current panel buffer (big-endian RGB565)
+        """
+        self.previous, self.current = self.current, self.previous
+        if layer is None:
+            self._pack(image, self.current)
+            return self.current
+        key, background, boxes = layer
+        np.copyto(self.current, self.layers.get(key, lambda: self._layer(background)))
+        w, h = self.size
+        for x0, y0, x1, y1 in boxes:
+            box = (max(x0, 0), max(y0, 0), min(x1, w), min(y1, h))
+            if (box[2] <= box[0]) or (box[3] <= box[1]):
+                continue
+            rows, cols = panel_slice(box, self.rotation, self.size)
+            self._pack(image.crop(box), self.current[rows, cols])
+        return self.current
+
+
+class DamageTracker:
+    """Send only the changed parts of each frame to the ST7789.
+
+    Each frame is converted to RGB565 in panel orientation and compared with
+    the previous one. Changed rows are grouped into bands, each band is
+    narrowed to its changed columns, and only those windows are written using
+    the controller's column/row address window. Identical frames send nothing.
+    Pixel data is passed to the driver as views of the persistent RGB565
+    buffers rather than as freshly built lists.
+
+    Args:
+        disp (st7789.ST7789): Display driver
+        partial (bool): Send changed windows only (False sends full frames)
+        merge_gap (int): Unchanged rows between two bands that are still merged
+                         into one window (saves window setup overhead)
+        full_ratio (float): Changed fraction above which the full frame is sent
+
+    Example:
+        >>> frames = DamageTracker(disp)
+        >>> sent = frames.display(img)
+    """
+
+    def __init__(self, disp, partial=True, merge_gap=8, full_ratio=0.6):
+        self.disp = disp
+        self.partial = partial
+        self.merge_gap = merge_gap
+        self.full_ratio = full_ratio
+        geometry = display_geometry(disp)
+        self.rotation = geometry.rotation
+        self.framebuffer = RGB565Framebuffer(geometry.size, self.rotation)
+        self.changed = np.empty(self.framebuffer.current.shape, dtype=bool)
+        self.scratch = np.empty(self.framebuffer.current.size, dtype='>u2')
+        self.previous = None
+        self.digest = None
+
+    def reset(self):
+        """Forget the previous frame so the next one is sent in full."""
+        self.previous = None
+        self.digest = None
+
+    def fingerprint(self, image, layer=None):
+        """Hash a frame cheaply enough to run before conversion.
+
+        With a layer description only the layer key and the pixels of the
+        areas drawn on top of it are hashed, since the rest of the frame is
+        the cached background.
+
+        Args:
+            image (PIL.Image): Frame in display coordinates
+            layer (tuple): Optional background description, see
+                           RGB565Framebuffer.convert()
+
+        Returns:
+            bytes: Frame digest
+        """
+        digest = hashlib.blake2b(digest_size=16)
+        if layer is None:
+            digest.update(image.tobytes())
+        else:
+            key, _, boxes = layer
+            digest.update(repr((key, boxes)).encode('utf-8', 'surrogateescape'))
+            for box in boxes:
+                digest.update(image.crop(box).tobytes())
+        return digest.digest()
+
+    def _send(self, frame, x0, y0, x1, y1):
+        self.disp.set_window(x0, y0, x1, y1)
+        window = frame[y0:y1 + 1, x0:x1 + 1]
+        if not window.flags.c_contiguous:
+            # partial-width windows are gathered into one reusable buffer
+            packed = self.scratch[:window.size].reshape(window.shape)
+            np.copyto(packed, window)
+            window = packed
+        data = memoryview(window.view(np.uint8)).cast('B')
+        for i in range(0, len(data), 4096):
+            self.disp.data(data[i:i + 4096])
+        return len(data)
+
+    def regions(self, frame):
+        """Return the changed windows of a frame as (x0, y0, x1, y1) tuples.
+
+        Args:
+            frame (numpy.ndarray): RGB565 frame in panel orientation
+
+        Returns:
+            list: Inclusive panel-coordinate windows; the whole panel if there
+                  is no previous frame or most of it changed
+        """
+        height, width = frame.shape
+        full = [(0, 0, width - 1, height - 1)]
+        if (not self.partial) or (self.previous is None) or (self.previous.shape != frame.shape):
+            return full
+        changed = np.not_equal(frame, self.previous, out=self.changed)
+        rows = np.flatnonzero(changed.any(axis=1))
+        if rows.size == 0:
+            return []
+        # split the changed rows into bands wherever the gap is large enough
+        splits = np.flatnonzero(np.diff(rows) > self.merge_gap) + 1
+        windows = []
+        area = 0
+        for band in np.split(rows, splits):
+            y0, y1 = int(band[0]), int(band[-1])
+            cols = np.flatnonzero(changed[y0:y1 + 1].any(axis=0))
+            x0, x1 = int(cols[0]), int(cols[-1])
+            windows.append((x0, y0, x1, y1))
+            area += (x1 - x0 + 1) * (y1 - y0 + 1)
+        if area > self.full_ratio * width * height:
+            return full
+        return windows
+
+    def display(self, image, layer=None):
+        """Update the panel with a new frame.
+
+        Args:
+            image (PIL.Image): Frame in display coordinates
+            layer (tuple): Optional background description, see
+                           RGB565Framebuffer.convert()
+
+        Returns:
+            int: Number of pixel bytes sent over SPI
+        """
+        with stats.time('hash'):
+            digest = self.fingerprint(image, layer)
+        if (digest == self.digest) and (self.previous is not None):
+            # identical to what the panel shows: no conversion, no SPI
+            stats.count('frames_skipped')
+            return 0
+        self.digest = digest
+        with stats.time('convert'):
+            frame = self.framebuffer.convert(image, layer)
+            windows = self.regions(frame)
+        with stats.time('spi'):
+            sent = 0
+            for window in windows:
+                sent += self._send(frame, *window)
+        self.previous = frame
+        stats.count('frames')
+        stats.count('spi_bytes', sent)
+        return sent
+
+
+class FrameScheduler:
+    """Deadline based frame pacing for the display loop.
+
+    Animation frames are scheduled on monotonic deadlines at the configured
+    frame rate instead of sleeping a fixed time after each frame, so slow
+    frames do not lower the scroll speed and fast ones do not waste CPU. When
+    nothing is animating the loop sleeps until the next external event or
+    timer, i.e. it renders at 0 fps.
+
+    Args:
+        fps (float): Target animation frame rate
+        clock (callable): Monotonic clock (a virtual one when replaying a trace)
+
+    Example:
+        >>> scheduler = FrameScheduler(20)
+        >>> timeout = scheduler.timeout(animating, [blank_deadline])
+        >>> steps = scheduler.frame(time.monotonic())
+    """
+
+    def __init__(self, fps=FPS, clock=time.monotonic):
+        self.period = 1.0 / max(fps, 1)
+        self.clock = clock
+        self.deadline = None
+        self.last_frame = None
+
+    def reset(self):
+        """Forget the frame history, e.g. after animations were paused."""
+        self.deadline = None
+        self.last_frame = None
+
+    def timeout(self, animating, wakeups=()):
+        """Return how long the loop may sleep.
+
+        Args:
+            animating (bool): True while something on screen is moving
+            wakeups (list): Monotonic times at which the loop must wake anyway
+
+        Returns:
+            float: Seconds until the next frame deadline or wakeup
+        """
+        now = self.clock()
+        deadlines = list(wakeups)
+        if animating:
+            if self.deadline is None:
+                self.deadline = now
+            deadlines.append(self.deadline)
+        else:
+            self.reset()
+        if not deadlines:
+            return IDLE_MAX
+        return min(max(0.0, min(deadlines) - now), IDLE_MAX)
+
+    def due(self, now):
+        """Return True if an animation frame deadline has passed."""
+        return (self.deadline is not None) and (now >= self.deadline)
+
+    def frame(self, now):
+        """Record a rendered frame and schedule the next deadline.
+
+        Args:
+            now (float): Monotonic time of the frame
+
+        Returns:
+            float: Time since the previous frame in 50 ms scroll steps
+        """
+        steps = 1.0
+        if self.last_frame is not None:
+            # cap the catch-up so a stall does not make text jump across the screen
+            steps = min((now - self.last_frame) / FRAME_TIME, 4.0)
+        self.last_frame = now
+        if self.deadline is not None:
+            self.deadline += self.period
+            if self.deadline < now:
+                # running late: drop the missed frames rather than bursting
+                self.deadline = now + self.period
+        return steps
+
+
+class FramePipeline:
+    """Hand rendered frames to a separate SPI transfer thread.
+
+    The renderer draws into one of two preallocated frame buffers while the
+    other one is being transferred. Only the newest frame waits for transfer:
+    if the renderer finishes another frame before the transfer thread is
+    ready, the stale pending frame is dropped and its buffer reused. SPI time
+    therefore no longer adds to the frame time of the render loop.
+
+    Args:
+        target: Object with a display(image, layer) method (DamageTracker)
+        size (tuple): Frame size in pixels
+        threaded (bool): False sends every frame from submit() instead, so
+                         none are dropped (deterministic trace replay)
+
+    Example:
+        >>> pipeline = FramePipeline(DamageTracker(disp), GEOMETRY.size)
+        >>> frame = pipeline.acquire()
+        >>> pipeline.submit(frame)
+    """
+
+    def __init__(self, target, size, threaded=True):
+        self.target = target
+        self.free = [Image.new('RGB', size) for _ in range(2)]
+        self.pending = None
+        self.dropped = 0
+        self.running = True
+        self.cond = threading.Condition()
+        self.thread = None
+        if threaded:
+            self.thread = threading.Thread(target=self._run, name='spi-transfer', daemon=True)
+            self.thread.start()
+
+    def acquire(self):
+        """Return a frame buffer to render into (reclaiming a stale frame if needed)."""
+        with self.cond:
+            while True:
+                if self.free:
+                    return self.free.pop()
+                if self.pending is not None:
+                    frame, self.pending = self.pending[0], None
+                    self.dropped += 1
+                    stats.count('frames_dropped')
+                    return frame
+                self.cond.wait()
+
+    def submit(self, frame, layer=None):
+        """Queue a rendered frame for transfer, replacing any stale pending frame.
+
+        Args:
+            frame (PIL.Image): Buffer returned by acquire()
+            layer (tuple): Optional background description passed on to the
+                           target (see RGB565Framebuffer.convert())
+        """
+        if self.thread is None:
+            try:
+                self.target.display(frame, layer)
+            finally:
+                self.free.append(frame)
+            return
+        with self.cond:
+            if self.pending is not None:
+                self.free.append(self.pending[0])
+                self.dropped += 1
+                stats.count('frames_dropped')
+            self.pending = (frame, layer)
+            self.cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while self.running and self.pending is None:
+                    self.cond.wait()
+                if not self.running:
+                    return
+                (frame, layer), self.pending = self.pending, None
+            try:
+                self.target.display(frame, layer)
+            finally:
+                with self.cond:
+                    self.free.append(frame)
+                    self.cond.notify_all()
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+
+
+def trace_delta(previous, current):
+    """Return the keys of current that differ from previous (removed keys as None)."""
+    delta = {key: value for key, value in current.items() if previous.get(key) != value}
+    delta.update((key, None) for key in previous if key not in current)
+    return delta
+
+
+class TraceRecorder:
+    """Record the display loop's inputs for offline replay.
+
+    Every metadata read (MetadataWatcher) and MPD
+    status refresh is written with its time since the start of the trace,
+    but only when it changed, and only the keys that changed. Lines are
+    JSON, ``[seconds, "meta" or "status", delta]``, after a header line
+    describing the screen. They are appended every TRACE_FLUSH seconds as
+    a complete gzip member, so a recording cut off by SIGKILL or a power
+    loss stays readable up to its last flush. See TraceReplay for playing
+    a trace back.
+
+    Args:
+        path (str): Trace file (relative paths are below the script)
+        screen (str): Screen name stored in the header
+        size (tuple): Frame size stored in the header
+        clock (callable): Monotonic clock
+
+    Example:
+        >>> recorder = TraceRecorder('cache/trace.jsonl.gz')
+        >>> recorder.record('status', await mpd.status(), time.monotonic())
+        >>> recorder.close()
+    """
+
+    def __init__(self, path, screen='default', size=None, clock=time.monotonic):
+        self.path = os.path.join(script_path, path)
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self.start = clock()
+        self.flushed = self.start
+        self.last = {'meta': {}, 'status': {}}
+        self.pending = []
+        header = {'trace': 1, 'screen': screen, 'size': list(size or GEOMETRY.size), 'version': __version__}
+        with gzip.open(self.path, 'wt', encoding='utf-8') as trace:
+            trace.write(json.dumps(header) + '\n')
+
+    def record(self, kind, value, now):
+        """Queue a metadata ('meta') or MPD status ('status') snapshot if it changed."""
+        current = dict(value)
+        delta = trace_delta(self.last[kind], current)
+        if not delta:
+            return
+        self.last[kind] = current
+        self.pending.append(json.dumps([round(now - self.start, 3), kind, delta], separators=(',', ':')) + '\n')
+
+    @property
+    def deadline(self):
+        """Time of the next flush, or None while nothing is queued."""
+        return (self.flushed + TRACE_FLUSH) if self.pending else None
+
+    def flush(self, now, force=False):
+        """Append the queued lines as one gzip member once TRACE_FLUSH seconds passed."""
+        if (not self.pending) or ((not force) and (now - self.flushed < TRACE_FLUSH)):
+            return
+        with gzip.open(self.path, 'at', encoding='utf-8') as trace:
+            trace.writelines(self.pending)
+        self.pending = []
+        self.flushed = now
+
+    def close(self):
+        self.flush(self.flushed, force=True)
+
+
+def read_trace(path):
+    """Read the lines of a trace, up to where a cut-off recording ends.
+
     Returns:
-        PIL.Image: Cover art image object (240x240 or will be resized later)
-    
-    Note:
-        For library files, checks for embedded art first, then searches for
-        common cover image filenames in the same directory as the audio file.
-        Supported cover image formats: jpg, jpeg, png, tif, tiff (case-insensitive).
+        list: Decoded lines of all complete (and the readable part of a
+              truncated) gzip member, without a partial last line
     """
-    cover = None
-    cover = Image.open(script_path + '/images/default-cover-v6.jpg')
-    covers = ['Cover.jpg', 'cover.jpg', 'Cover.jpeg', 'cover.jpeg', 'Cover.png', 'cover.png', 'Cover.tif', 'cover.tif', 'Cover.tiff', 'cover.tiff',
-		'Folder.jpg', 'folder.jpg', 'Folder.jpeg', 'folder.jpeg', 'Folder.png', 'folder.png', 'Folder.tif', 'folder.tif', 'Folder.tiff', 'folder.tiff']
-    if metaDict['source'] == 'radio':
-        if 'coverurl' in metaDict:
-            rc = '/var/local/www/' + metaDict['coverurl']
-            if path.exists(rc):
-                if rc != '/var/local/www/images/default-cover-v6.svg':
-                    cover = Image.open(rc)
-
-    elif metaDict['source'] == 'airplay':
-        cover = ap_back
-    elif metaDict['source'] == 'bluetooth':
-        cover = bt_back
-    elif metaDict['source'] == 'input':
-        cover = jp_back
-    elif metaDict['source'] == 'spotify':
-        cover = sp_back
-    elif metaDict['source'] == 'squeeze':
-        cover = sq_back
-    else:
-        if 'file' in metaDict:
-            if len(metaDict['file']) > 0:
+    with open(path, 'rb') as trace:
+        data = trace.read()
+    text = b''
+    while data:
+        member = zlib.decompressobj(wbits=31)
+        try:
+            text += member.decompress(data)
+        except zlib.error:
+            break
+        if not member.eof:
+            # truncated member (power loss while flushing)
+            break
+        data = member.unused_data
+    lines = text.decode('utf-8', errors='replace').split('\n')
+    # the last element is '' after a complete line, or a cut-off line
+    return lines[:-1]
 
-                fp = '/var/lib/mpd/music/' + metaDict['file']   
-                mf = MediaFile(fp)     
-                if mf.art:
-                    cover = Image.open(BytesIO(mf.art))
-                    return cover
+
+class TraceReplay:
+    """Play a recorded trace through the display loop in virtual time.
+
+    Stands in for both the MPD connection and the metadata watcher of run():
+    waiting advances a virtual clock to the next recorded change (or the
+    loop's own timeout, whichever is first) instead of sleeping, so frames,
+    scroll positions and the time bar depend only on the trace and the
+    settings. At the end of each loop pass the panel is checked: if a frame
+    reached it, its virtual time, the real time the pass took, the SPI bytes
+    and a hash of the panel contents are recorded.
+
+    Args:
+        path (str): Trace written by TraceRecorder
+        display (MemoryDisplay): Offscreen display the loop draws on
+        speed (float): 0 replays as fast as possible, 1 at recorded speed,
+                       2 twice as fast, ...
+        stop (threading.Event): Set once the trace is exhausted
+
+    Example:
+        >>> replay = TraceReplay('trace.jsonl.gz', MemoryDisplay(240, 240))
+        >>> asyncio.run(run(screen, SharedResources(), replay.stop, replay=replay))
+        >>> replay.frames[0]
+        (0.0, 41.2, 115200, '3fa2c1d09be4e871')
+    """
+
+    def __init__(self, path, display, speed=0.0, stop=None):
+        lines = read_trace(path)
+        self.header = json.loads(lines[0])
+        self.events = [json.loads(line) for line in lines[1:] if line.strip()]
+        self.display = display
+        self.speed = speed
+        self.stop = stop or threading.Event()
+        # start with the first snapshots, like the loop after connecting
+        self.time = self.events[0][0] if self.events else 0.0
+        self.index = 0
+        # the last frame is kept on screen a little after the final event
+        self.end = (self.events[-1][0] if self.events else 0.0) + 1.0
+        self.current = {'meta': {}, 'status': {}}
+        self.stalled = 0
+        self.status_time = 0.0
+        # what MetadataWatcher reports before the first complete read
+        self.metadata = MappingProxyType({'source': 'library'})
+        self.connected = True
+        self.frames = []
+        self.panel = (display.frames, display.bytes)
+        self.pass_start = time.perf_counter()
+
+    def clock(self):
+        return self.time
+
+    @property
+    def retry_at(self):
+        return self.time
+
+    async def wait_ready(self, timeout, max_delay=1.0):
+        return True
+
+    def _account(self):
+        # a finished loop pass: note the frame it put on the panel, if any
+        if (self.display.frames, self.display.bytes) == self.panel:
+            return
+        self.stalled = 0
+        sent = self.display.bytes - self.panel[1]
+        self.panel = (self.display.frames, self.display.bytes)
+        digest = hashlib.blake2b(self.display.buffer.tobytes(), digest_size=8).hexdigest()
+        self.frames.append((round(self.time, 3), (time.perf_counter() - self.pass_start) * 1000, sent, digest))
+
+    async def wait(self, events, timeout):
+        """Advance the virtual clock to the next change; see MPDConnection.wait()."""
+        self._account()
+        target = self.time + timeout
+        following = self.events[self.index][0] if self.index < len(self.events) else self.end
+        target = min(target, following)
+        if target <= self.time:
+            # the loop keeps asking for the current instant without drawing
+            # (e.g. before the first status snapshot): move on to the next
+            # recorded change
+            self.stalled += 1
+            if self.stalled > 1:
+                target = following
+        else:
+            self.stalled = 0
+        if target >= self.end:
+            target = self.end
+            self.stop.set()
+        if self.speed > 0:
+            await asyncio.sleep((target - self.time) / self.speed)
+        self.time = target
+        changed = []
+        while (self.index < len(self.events)) and (self.events[self.index][0] <= self.time):
+            _, kind, delta = self.events[self.index]
+            self.index += 1
+            state = self.current[kind]
+            for key, value in delta.items():
+                if value is None:
+                    state.pop(key, None)
                 else:
-                    for it in covers:
-                        cp = os.path.dirname(fp) + '/' + it
-                        
-                        if path.exists(cp):
-                            cover = Image.open(cp)
-                            return cover
-    return cover
+                    state[key] = value
+            self.stalled = 0
+            if kind == 'meta':
+                self.metadata = MappingProxyType(dict(state))
+                changed.append('metadata')
+            else:
+                self.status_time = self.time
+                changed.extend(MPD_SUBSYSTEMS[:2])
+        self.pass_start = time.perf_counter()
+        return changed
+
+    async def status(self):
+        # like MPD, report the position at the time of the request
+        status = dict(self.current['status'])
+        if (status.get('state') == 'play') and ('elapsed' in status):
+            elapsed = float(status['elapsed']) + (self.time - self.status_time)
+            if float(status.get('duration', 0)) > 0:
+                elapsed = min(elapsed, float(status['duration']))
+            status['elapsed'] = '{:.3f}'.format(elapsed)
+        return status
+
+    async def command(self, name, *args):
+        # nothing is queued in a trace, so there is nothing to prefetch
+        return []
+
+    def read(self):
+        return self.metadata
+
+    def fileno(self):
+        return None
+
+    def close(self):
+        pass
+
 
+class SharedResources:
+    """Caches and workers shared by all screens of one process.
 
-def main():
+    The compiled layouts (one per display geometry), the disk cover cache,
+    the composed background and text sprite caches and the prefetch pool
+    exist once, so screens showing the same album decode
+    and rasterise it once. Cache sizes grow with the number of screens, the
+    assets, fonts and cover lookups are module level and shared anyway.
+
+    Args:
+        screens (int): Number of screens drawing from the caches
+
+    Example:
+        >>> shared = SharedResources(2)
+        >>> shared.listeners.append(events)
+        >>> shared.close()
+    """
+
+    def __init__(self, screens=1):
+        self.listeners = []
+        self.cover_cache = CoverCache(COVER_CACHE_DIR, COVER_CACHE_ENTRIES, COVER_CACHE_MB)
+        self.layers = LayerCache(size=LAYER_CACHE_SIZE * screens)
+        self.sprites = LayerCache(size=SPRITE_CACHE_SIZE * screens, name='sprite')
+        self.layouts = {}
+        # artwork is always loaded off the render loops; prefetch only adds the next track
+        self.prefetcher = Prefetcher(self.cover_cache, PREFETCH_WORKERS, SHADE, notify=self._notify,
+                                     pending=2 * screens)
+
+    def layout(self, geometry):
+        """Return the compiled layout for a display geometry, compiling it once."""
+        layout = self.layouts.get(geometry)
+        if layout is None:
+            layout = self.layouts[geometry] = compile_layout(LAYOUT, geometry=geometry)
+        return layout
+
+    def _notify(self):
+        # worker thread: wake every screen, the ones waiting for the cover pick it up
+        for events in self.listeners:
+            events.post('cover')
+
+    def close(self):
+        self.prefetcher.shutdown()
+
+
+def main(stop=None, screens=None):
     """Main display loop for TFT-MoodeCoverArt.
     
-    Initializes the display and runs the main event loop that:
-    - Monitors MPD service status
+    Runs the asyncio event loop that, for every configured screen:
+    - Waits for MPD idle events, metadata changes and timers
     - Reads metadata from Moode Audio
     - Retrieves and caches cover art
     - Renders text with smooth scrolling
@@ -317,277 +3193,411 @@ def main():
     - Smooth 20fps rendering for text scrolling
     - Display blanking timeout based on config
     
+    Args:
+        stop (threading.Event): Optional event that ends the loop when set
+                                (used by benchmarks and the offline tools)
+        screens (list): Screen tuples to drive, see configured_screens()
+    
     Raises:
         KeyboardInterrupt: Caught to gracefully shut down display
     
     Note:
-        If MPD service is not active after 30 seconds, displays an error
-        message and stops. The loop runs continuously until interrupted.
+        If a player does not accept connections within ``start_timeout``
+        seconds, its screen displays an error message and stops. The loop runs
+        continuously until interrupted. Without a ``screens`` list it uses the
+        display in the module level ``disp`` (see create_display()).
+    """
+    if screens is None:
+        screens = configured_screens()
+    asyncio.run(serve(screens, stop))
+
+
+async def serve(screens, stop=None):
+    """Drive several screens from one event loop with shared caches.
+
+    The metrics exporter and the buttons exist once per process; buttons
+    control the first screen's player. An error in one screen's loop is
+    printed and ends that screen only.
+
+    Args:
+        screens (list): Screen tuples, see configured_screens()
+        stop (threading.Event): Optional event that ends the loops when set
+    """
+    shared = SharedResources(len(screens))
+    exporter = None
+    if METRICS == 1:
+        # settings worth correlating with frame and SPI timings
+        stats.gauge('spi_speed_hz', SPI_SPEED)
+        stats.gauge('scrollspeed', SCROLLSPEED)
+        stats.gauge('fps_target', FPS)
+        stats.gauge('partial_update', PARTIAL_UPDATE)
+        stats.gauge('screens', len(screens))
+        exporter = MetricsExporter(stats, METRICS_TEXTFILE, METRICS_SOCKET, METRICS_INTERVAL)
+    async def guarded(screen, buttons):
+        # a failing screen is reported and stops; the others keep running
+        try:
+            await run(screen, shared, stop, buttons=buttons)
+        except Exception:
+            print("screen {} stopped:".format(screen.name))
+            traceback.print_exc()
+
+    try:
+        await asyncio.gather(*(guarded(screen, index == 0) for index, screen in enumerate(screens)))
+    finally:
+        if exporter is not None:
+            exporter.stop()
+        shared.close()
+
+
+async def run(screen, shared, stop=None, buttons=False, replay=None):
+    """Display loop coroutine of one screen.
+
+    MPD idle events, currentsong.txt changes, finished cover loads, animation
+    frames and timers are all awaited through one LoopEvents instance, so the
+    loop wakes for whichever comes first.
+
+    Args:
+        screen (Screen): Display and player to drive
+        shared (SharedResources): Caches and workers shared with other screens
+        stop (threading.Event): Optional event that ends the loop when set
+        buttons (bool): Whether this screen handles the Pirate Audio buttons
+        replay (TraceReplay): Recorded trace to play instead of MPD and the
+                              metadata file, in virtual time with every
+                              frame sent and covers loaded in line
     """
+    disp = screen.display
+    clock = time.monotonic if replay is None else replay.clock
     disp.set_backlight(True)
     
-    filename = '/var/local/www/currentsong.txt'
+    filename = screen.metadata
+    music_dir = screen.music_dir
+    events = LoopEvents(asyncio.get_running_loop())
+    shared.listeners.append(events)
 
     c = 0
-    ss = 0
-    x1 = 20.0
-    x2 = 20.0
-    x3 = 20.0
-    title_top = 105
-    volume_top = 184
-    time_top = 222
-    act_mpd = isServiceActive('mpd')
-    SHADE = displayConf['shadow']
-    
+    geometry = display_geometry(disp)
+    size = width, height = geometry.size
+    layout = shared.layout(geometry)
+    # file names (sources without cover art) and messages
+    font_file = load_font(FONT, geometry.scaled(30))
+    font_message = load_font(FONT, geometry.scaled(24))
+    # scroll position of each op (only text ops use theirs), and the text it belongs to
+    positions = [op.left if op.kind == 'text' else 0.0 for op in layout.ops]
+    texts = [None] * len(layout.ops)
+    frames = DamageTracker(disp, partial=(PARTIAL_UPDATE == 1))
+    # show the default cover straight away instead of a dark panel while MPD starts
+    frames.display(load_asset('default-cover-v6.jpg', size).convert('RGB'))
     # Cache variables for optimization
     prev_cover_path = None
-    cached_cover = None
-    cached_resized_cover = None
-    prev_state = {}
+    cached_background = None
+    cover_mean = 50
+    palette = cover_palette(cover_mean)
+    layers = shared.layers
+    cover_cache = shared.cover_cache
+    sprites = shared.sprites
+    prefetcher = shared.prefetcher
+    next_id = None
+    next_key = None
+    background_path = None
+    pending_cover = None
+    prev_fingerprint = None
     needs_redraw = True
     
     # Scrolling text tracking
     has_scrolling_text = False
 
-    if act_mpd == True:
-        print("mpd is active")
-        while True:
-            client = musicpd.MPDClient()   # create client object
-            try:     
-                client.connect()           # use MPD_HOST/MPD_PORT
-            except:
-                pass
-            else:                  
-                moode_meta = getMoodeMetadata(filename)
-                mpd_status = client.status()
-                
-                # Check if anything has changed to avoid unnecessary redrawing
-                current_state = {
-                    'file': moode_meta.get('file', ''),
-                    'state': mpd_status.get('state', ''),
-                    'volume': mpd_status.get('volume', ''),
-                    'elapsed': mpd_status.get('elapsed', '')
-                }
-                
-                needs_redraw = (current_state != prev_state) or has_scrolling_text
-                
+    pipeline = FramePipeline(frames, size, threaded=(replay is None))
+    mpd = MPDConnection(screen.host, screen.port) if replay is None else replay
+    watcher = None
+    recorder = None
+    button_input = None
+    # everything is released in the finally clause, also when the task is
+    # cancelled (Ctrl-C, SIGTERM or another screen failing)
+    try:
+        act_mpd = await mpd.wait_ready(MPD_START_TIMEOUT)
+
+        if act_mpd == True:
+            print("mpd is active ({})".format(screen.name))
+            watcher = MetadataWatcher(filename) if replay is None else replay
+            if TRACE_RECORD and (replay is None):
+                recorder = TraceRecorder(TRACE_RECORD.format(screen=screen.name), screen.name, size)
+            if watcher.fileno() is not None:
+                events.watch(watcher.fileno(), 'metadata')
+            if buttons and (BUTTONS == 1):
+                try:
+                    button_input = Buttons(BUTTON_PINS, BUTTON_BOUNCE, lambda: events.post('button'), gpio)
+                except (ImportError, RuntimeError, OSError) as e:
+                    print("buttons unavailable: {}".format(e))
+            mpd_status = {}
+            status_time = 0.0
+            playback = PlaybackClock()
+            blank_start = None
+            backlight = True
+            scheduler = FrameScheduler(FPS, clock)
+            while (stop is None) or (not stop.is_set()):
+                # Sleep until MPD or the metadata file change, a cover is ready, the next
+                # animation frame is due, or a timer (elapsed refresh, blanking) needs servicing
+                animating = backlight and has_scrolling_text
+                wakeups = []
+                timebar_shown = (layout.timebar is not None) and (mpd_status.get('state') == 'play')
+                if timebar_shown and backlight:
+                    # the bar follows the interpolated clock; MPD is only asked to resync
+                    wakeups.append(status_time + MPD_RESYNC)
+                    next_pixel = playback.next_change(clock(), layout.timebar.span)
+                    if next_pixel is not None:
+                        wakeups.append(next_pixel)
+                if (blank_start is not None) and backlight:
+                    wakeups.append(blank_start + BLANK)
+                if watcher.fileno() is None:
+                    wakeups.append(clock() + MPD_IDLE_TIMEOUT)
+                if not mpd_status:
+                    # nothing known yet (startup or reconnect): query as soon as MPD can be reached
+                    wakeups.append(mpd.retry_at)
+                if (recorder is not None) and (recorder.deadline is not None):
+                    wakeups.append(recorder.deadline)
+                with stats.time('sleep'):
+                    changed = await mpd.wait(events, scheduler.timeout(animating, wakeups))
+                now = clock()
+                if (button_input is not None) and ('button' in changed):
+                    # redraw from the predicted status right away; MPD's idle events
+                    # then trigger the status refresh that reconciles it
+                    for action in button_input.take():
+                        if mpd_status:
+                            mpd_status = await press_button(mpd, mpd_status, action)
+                # elapsed is only reported on request; between MPD events it is interpolated
+                mpd_changed = [sub for sub in changed if sub in MPD_SUBSYSTEMS]
+                if mpd_changed or not mpd_status or (timebar_shown and (now - status_time >= MPD_RESYNC)):
+                    with stats.time('mpd'):
+                        mpd_status = await mpd.status()
+                    status_time = now
+                    playback.update(mpd_status, now)
+                    if recorder is not None:
+                        recorder.record('status', mpd_status, now)
+                    if PREFETCH == 1:
+                        # prepare the next queued track while this one plays
+                        # other screens' prefetches are left alone
+                        if ('playlist' in mpd_changed) and (next_key is not None):
+                            prefetcher.cancel([next_key], layout)
+                            next_id = next_key = None
+                        if mpd_status.get('nextsongid') != next_id:
+                            next_id = mpd_status.get('nextsongid')
+                            upcoming = await queued_track(mpd, mpd_status)
+                            if upcoming is not None:
+                                next_key = cover_cache_key(upcoming, music_dir)
+                                prefetcher.request(upcoming, layout, music_dir)
+                # read even while disconnected, so a pending inotify event is consumed
+                with stats.time('metadata'):
+                    moode_meta = watcher.read()
+                if recorder is not None:
+                    recorder.record('meta', moode_meta, now)
+                    recorder.flush(now)
+
+                if not mpd.connected:
+                    if mpd_status:
+                        # MPD went away: stop the time bar and forget the play state
+                        # until the reconnect refreshes it
+                        mpd_status = {}
+                        playback.update(mpd_status, now)
+                    continue
+
+                if 'state' in mpd_status:
+                    if ((mpd_status['state'] == 'stop') and (BLANK != 0)) or ((mpd_status['state'] == 'pause') and (BLANK != 0) and (PAUSEBLANK != 0)):
+                        if blank_start is None:
+                            blank_start = now
+                        elif (now - blank_start >= BLANK) and backlight:
+                            disp.set_backlight(False)
+                            backlight = False
+                    else:
+                        blank_start = None
+                        if not backlight:
+                            disp.set_backlight(True)
+                            backlight = True
+                            # scroll positions were frozen while dark, resume smoothly
+                            scheduler.reset()
+
+                # Redraw only if something visible changed (or text is scrolling)
+                shown_status = playback.status(mpd_status, now)
+                fingerprint = render_fingerprint(moode_meta, shown_status, layout)
+                needs_redraw = (fingerprint != prev_fingerprint) or (animating and scheduler.due(now)) or (('cover' in changed) and (pending_cover is not None))
+            
                 if not needs_redraw:
-                    prev_state = current_state.copy()
-                    time.sleep(0.05)
                     continue
-                
+            
                 # Get cover with caching
                 cover_path = moode_meta.get('coverurl', '') + moode_meta.get('file', '')
                 if cover_path != prev_cover_path:
-                    cover = get_cover(moode_meta)
-                    cached_cover = cover
-                    cached_resized_cover = cover.resize((WIDTH, HEIGHT), Image.Resampling.LANCZOS)
+                    key = cover_cache_key(moode_meta, music_dir)
+                    if (key is None) or (cached_background is None) or (replay is not None):
+                        # nothing on screen yet, or a cheap built-in background
+                        pending_cover = None
+                        with stats.time('cover'):
+                            prepared = load_cover(moode_meta, cover_cache, size, music_dir)
+                        ready = (prepared, {})
+                    else:
+                        # keep showing the previous artwork until the worker posts 'cover'
+                        pending_cover = (cover_path, moode_meta, key)
+                        ready = prefetcher.poll(moode_meta, key, layout, music_dir)
                     prev_cover_path = cover_path
-                    # Reset text positions when track changes
-                    x1 = x2 = x3 = 20.0
-                    has_scrolling_text = False
-                else:
-                    cover = cached_cover
-                
-                prev_state = current_state.copy()
-                
-                mn = 50
-                if OVERLAY == 3:
-                    img.paste(cached_resized_cover.convert('RGB'))
+                elif pending_cover is not None:
+                    ready = prefetcher.poll(pending_cover[1], pending_cover[2], layout, music_dir)
                 else:
-                    img.paste(cached_resized_cover.filter(ImageFilter.GaussianBlur).convert('RGB'))
-                
+                    ready = None
+            
+                if ready is not None:
+                    prepared, ready_sprites = ready
+                    for key, sprite in ready_sprites.items():
+                        sprites.put(key, sprite)
+                    if OVERLAY == 3:
+                        cached_background = prepared.image
+                    else:
+                        cached_background = prepared.blurred
+                    # colours only depend on the cover, not on the frame
+                    cover_mean = prepared.mean
+                    palette = cover_palette(prepared.mean, prepared.bands)
+                    background_path = prev_cover_path
+                    pending_cover = None
+            
+                prev_fingerprint = fingerprint
+                steps = scheduler.frame(now)
+                compose_start = time.perf_counter()
+            
+                txt_col, str_col, _, dark = text_colours(cover_mean)
+            
+                # Static background (cover, blur and control icons) is composed once per change
+                icon = None
+                if (moode_meta['source'] == 'library') or (moode_meta['source'] == 'radio'):
+                    icon = overlay_icon(shown_status, dark)
+                background = layers.get((background_path, icon, size), lambda: compose_background(cached_background, icon))
+                img = pipeline.acquire()
+                img.paste(background)
+                # areas drawn on top of the background, so only those need converting
+                damage = []
+            
                 # Create draw object for this frame
                 draw = ImageDraw.Draw(img, 'RGBA')
-                
-                if 'state' in mpd_status:
-                    if ((mpd_status['state'] == 'stop') and (BLANK != 0)) or ((mpd_status['state'] == 'pause') and (BLANK != 0) and (PAUSEBLANK != 0)):
-                        if ss < BLANK:
-                            ss = ss + 1
-                        else:
-                            disp.set_backlight(False)
-                    else:
-                        ss = 0
-                        disp.set_backlight(True)
-                
-                
-                im_stat = ImageStat.Stat(cover) 
-                im_mean = im_stat.mean
-                mn = mean(im_mean)
-                
-                #txt_col = (255-int(im_mean[0]), 255-int(im_mean[1]), 255-int(im_mean[2]))
-                txt_col = (255,255,255)
-                str_col = (15,15,15)
-                bar_col = (255, 255, 255, 255)
-                dark = False
-                if mn > 175:
-                    txt_col = (55,55,55)
-                    str_col = (200,200,200)
-                    dark=True
-                    bar_col = (100,100,100,225)
-                if mn < 80:
-                    txt_col = (200,200,200)
-                    str_col = (55,55,55)
-                
+                # whether the next frame is needed is decided by the sprites drawn now,
+                # so a long title replaced by a short one stops the animation
+                has_scrolling_text = False
+            
                 if (moode_meta['source'] == 'library') or (moode_meta['source'] == 'radio'):
 
-                    if (OVERLAY > 0) and (OVERLAY < 3):
-                        if 'state' in mpd_status:
-                            if OVERLAY == 2:
-                                if mpd_status['state'] != 'play':
-                                    if dark is False:
-                                        img.paste(pause_icons, (0,0), pause_icons)
-                                    else:
-                                        img.paste(pause_icons_dark, (0,0), pause_icons_dark)
-                                else:
-                                    if dark is False:
-                                        img.paste(play_icons, (0,0), play_icons)
-                                    else:
-                                        img.paste(play_icons_dark, (0,0), play_icons_dark)
-                            elif OVERLAY == 1:
-                                if dark is False:
-                                    img.paste(vol_icons, (0,0), vol_icons)
-                                else:
-                                    img.paste(vol_icons_dark, (0,0), vol_icons_dark)
-                            
-                        else:
-                            img.paste(play_icons, (0,0), play_icons)
-    
-                        if 'volume' in mpd_status:
-                            vol = int(mpd_status['volume'])
-                            vol_x = int((vol/100)*(WIDTH - 33))
-                            draw.rectangle((5, volume_top, WIDTH-34, volume_top+8), (255,255,255,145))
-                            draw.rectangle((5, volume_top, vol_x, volume_top+8), bar_col)
-                    
-                    if OVERLAY < 3:    
-                        if TIMEBAR == 1:
-                            if 'elapsed' in  mpd_status:
-                                el_time = int(float(mpd_status['elapsed']))
-                                if 'duration' in mpd_status:
-                                    du_time = int(float(mpd_status['duration']))
-                                    dur_x = int((el_time/du_time)*(WIDTH-10))
-                                    draw.rectangle((5, time_top, WIDTH-5, time_top + 12), (255,255,255,145))
-                                    draw.rectangle((5, time_top, dur_x, time_top + 12), bar_col)
-        
-                        
-                        top = 7
-                        if 'artist' in moode_meta:
-                            bbox = draw.textbbox((0, 0), moode_meta['artist'], font_m)
-                            w1 = bbox[2] - bbox[0]
-                            
-                            if w1 <= WIDTH:
-                                # Center text if it fits
-                                x1 = (WIDTH - w1)//2
-                                if SHADE != 0:
-                                    draw.text((x1+SHADE, top+SHADE), moode_meta['artist'], font=font_m, fill=str_col)
-                                draw.text((x1, top), moode_meta['artist'], font=font_m, fill=txt_col)
-                            else:
-                                # Continuous scrolling with gap
-                                has_scrolling_text = True
-                                x1 = x1 - (SCROLLSPEED * 0.5)
-                                gap = 60  # Gap between repeated text
-                                if x1 < -(w1 + gap):
-                                    x1 = 0
-                                
-                                # Draw text twice for seamless loop
-                                if SHADE != 0:
-                                    draw.text((int(x1)+SHADE, top+SHADE), moode_meta['artist'], font=font_m, fill=str_col)
-                                    draw.text((int(x1+w1+gap)+SHADE, top+SHADE), moode_meta['artist'], font=font_m, fill=str_col)
-                                draw.text((int(x1), top), moode_meta['artist'], font=font_m, fill=txt_col)
-                                draw.text((int(x1+w1+gap), top), moode_meta['artist'], font=font_m, fill=txt_col)
-                        
-                        top = 35
-                        
-                        if 'album' in moode_meta:
-                            bbox = draw.textbbox((0, 0), moode_meta['album'], font_s)
-                            w2 = bbox[2] - bbox[0]
-                            
-                            if w2 <= WIDTH:
-                                # Center text if it fits
-                                x2 = (WIDTH - w2)//2
-                                if SHADE != 0:
-                                    draw.text((x2+SHADE, top+SHADE), moode_meta['album'], font=font_s, fill=str_col)
-                                draw.text((x2, top), moode_meta['album'], font=font_s, fill=txt_col)
-                            else:
-                                # Continuous scrolling with gap
-                                has_scrolling_text = True
-                                x2 = x2 - (SCROLLSPEED * 0.5)
-                                gap = 60
-                                if x2 < -(w2 + gap):
-                                    x2 = 0
-                                
-                                # Draw text twice for seamless loop
-                                if SHADE != 0:
-                                    draw.text((int(x2)+SHADE, top+SHADE), moode_meta['album'], font=font_s, fill=str_col)
-                                    draw.text((int(x2+w2+gap)+SHADE, top+SHADE), moode_meta['album'], font=font_s, fill=str_col)
-                                draw.text((int(x2), top), moode_meta['album'], font=font_s, fill=txt_col)
-                                draw.text((int(x2+w2+gap), top), moode_meta['album'], font=font_s, fill=txt_col)
-
-                        
-                        if 'title' in moode_meta:
-                            bbox = draw.textbbox((0, 0), moode_meta['title'], font_l)
-                            w3 = bbox[2] - bbox[0]
-                            
-                            if w3 <= WIDTH:
+                    # the compiled layout only holds what the overlay settings show
+                    for index, op in enumerate(layout.ops):
+                        if op.kind == 'bar':
+                            fill_x = bar_fill(op, shown_status)
+                            if fill_x is not None:
+                                draw.rectangle(op.track, BAR_TRACK)
+                                if fill_x > op.track[0]:
+                                    draw.rectangle((op.track[0], op.track[1], fill_x, op.track[3]), palette[op.name][2])
+                                damage.append(op.box)
+                        elif op.field in moode_meta:
+                            # Text is rasterised once per track into sprites; frames only crop and paste
+                            text = str(moode_meta[op.field])
+                            sprite = text_sprite(sprites, text, op.font, *palette[op.name][:2], SHADE, width)
+                            if text != texts[index]:
+                                # new text (track change or a radio title update) starts from the left
+                                texts[index] = text
+                                positions[index] = op.left
+                            if not sprite.scrolls:
                                 # Center text if it fits
-                                x3 = (WIDTH - w3)//2
-                                if SHADE != 0:
-                                    draw.text((x3+SHADE, title_top+SHADE), moode_meta['title'], font=font_l, fill=str_col)
-                                draw.text((x3, title_top), moode_meta['title'], font=font_l, fill=txt_col)
+                                positions[index] = (width - sprite.width)//2 if op.centre else op.left
                             else:
                                 # Continuous scrolling with gap
                                 has_scrolling_text = True
-                                x3 = x3 - (SCROLLSPEED * 0.5)
-                                gap = 60
-                                if x3 < -(w3 + gap):
-                                    x3 = 0
-                                
-                                # Draw text twice for seamless loop
-                                if SHADE != 0:
-                                    draw.text((int(x3)+SHADE, title_top+SHADE), moode_meta['title'], font=font_l, fill=str_col)
-                                    draw.text((int(x3+w3+gap)+SHADE, title_top+SHADE), moode_meta['title'], font=font_l, fill=str_col)
-                                draw.text((int(x3), title_top), moode_meta['title'], font=font_l, fill=txt_col)
-                                draw.text((int(x3+w3+gap), title_top), moode_meta['title'], font=font_l, fill=txt_col)
+                                positions[index] = sprite.scroll(positions[index], steps)
+                            damage.append(sprite.paste(img, positions[index], op.top))
 
 
                 else:
                     if 'file' in moode_meta:
                         txt = moode_meta['file'].replace(' ', '\n')
-                        bbox = draw.multiline_textbbox((0, 0), txt, font_l, spacing=6)
+                        bbox = draw.multiline_textbbox((0, 0), txt, font_file, spacing=6)
                         w3 = bbox[2] - bbox[0]
                         h3 = bbox[3] - bbox[1]
-                        x3 = (WIDTH - w3)//2
-                        y3 = (HEIGHT - h3)//2
+                        x3 = (width - w3)//2
+                        y3 = (height - h3)//2
                         if SHADE != 0:
-                            draw.text((x3+SHADE, y3+SHADE), txt, font=font_l, fill=str_col)
-                        draw.text((x3, y3), txt, font=font_l, fill=txt_col, spacing=6, align="center")
-            
-            
-            disp.display(img)
+                            draw.text((x3+SHADE, y3+SHADE), txt, font=font_file, fill=str_col)
+                        draw.text((x3, y3), txt, font=font_file, fill=txt_col, spacing=6, align="center")
+                        damage = None
 
-            if c == 0:
-                img.save(script_path+'/dump.jpg')
-                c += 1
 
-            time.sleep(0.05)
+                if c == 0:
+                    img.save(script_path+'/dump.jpg')
+                    c += 1
 
-        client.disconnect()
-    else:
-        draw = ImageDraw.Draw(img)
-        draw.rectangle((0,0,240,240), fill=(0,0,0))
-        txt = 'MPD not Active!\nEnsure MPD is running\nThen restart script'
-        bbox = draw.multiline_textbbox((0, 0), txt, font=font_m, spacing=4)
-        mlw = bbox[2] - bbox[0]
-        draw.multiline_text(((WIDTH-mlw)//2, 20), txt, fill=(255,255,255), font=font_m, spacing=4, align="center")
-        disp.display(img)
-        
+                stats.add('compose', time.perf_counter() - compose_start)
+                pipeline.submit(img, None if damage is None else ((background_path, icon, size), background, damage))
+
+        else:
+            pipeline.stop()
+            img = Image.new('RGB', size)
+            draw = ImageDraw.Draw(img)
+            draw.rectangle((0, 0) + size, fill=(0,0,0))
+            txt = 'MPD not Active!\nEnsure MPD is running\nThen restart script'
+            bbox = draw.multiline_textbbox((0, 0), txt, font=font_message, spacing=4)
+            mlw = bbox[2] - bbox[0]
+            draw.multiline_text(((width-mlw)//2, 20), txt, fill=(255,255,255), font=font_message, spacing=4, align="center")
+            frames.display(img)
+    finally:
+        if watcher is not None:
+            if watcher.fileno() is not None:
+                events.unwatch(watcher.fileno())
+            watcher.close()
+        if button_input is not None:
+            button_input.close()
+        pipeline.stop()
+        if recorder is not None:
+            recorder.close()
+        mpd.close()
+        shared.listeners.remove(events)
+
+
+
+def replay_trace(path, speed=0.0, geometry=None):
+    """Replay a recorded trace into an offscreen display.
 
+    Uses the configured settings (overlay, layout, fps, ...), a MemoryDisplay
+    of the given geometry and the real display loop; see TraceReplay. The
+    same trace and settings always produce the same frames, so the frame
+    hashes of two builds can be compared to bisect a rendering or
+    performance change.
+
+    Args:
+        path (str): Trace written with ``trace: record`` in config.yml
+        speed (float): 0 as fast as possible, 1 at recorded speed
+        geometry (Geometry): Display geometry (defaults to the configured one)
+
+    Returns:
+        list: (virtual seconds, pass milliseconds, SPI bytes, panel hash) per frame
+
+    Example:
+        >>> frames = replay_trace('cache/trace-default.jsonl.gz')
+        >>> len(frames), frames[-1][3]
+    """
+    geometry = geometry or GEOMETRY
+    display = MemoryDisplay(geometry.width, geometry.height, rotation=geometry.rotation)
+    display.geometry = geometry
+    display.begin()
+    replay = TraceReplay(path, display, speed)
+    shared = SharedResources(1)
+    try:
+        asyncio.run(run(Screen('replay', display, None, None, None, MUSIC_DIR), shared, replay.stop, replay=replay))
+    finally:
+        shared.close()
+    return replay.frames
 
 
 if __name__ == '__main__':
+    signal.signal(signal.SIGUSR1, memory_report)
+    signal.signal(signal.SIGTERM, terminate)
+    if not SCREENS:
+        disp = create_display()
+    screens = configured_screens()
     try:
-        main()
+        main(screens=screens)
     except KeyboardInterrupt:
-        disp.reset()
-        disp.set_backlight(False)
+        for screen in screens:
+            screen.display.reset()
+            screen.display.set_backlight(False)
         pass